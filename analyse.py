@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# Post-game analysis of an archive: every position of every archived game is
+# searched once (positions shared between games are looked up, not searched
+# again) on a pool of engine processes, and each game's accuracy, centipawn
+# loss, blunders and agreement with the engine's top choice are stored per
+# side in an sqlite file. Work is committed a batch of games at a time, so an
+# interrupted run picks up where it left off.
+import argparse
+import datetime
+import json
+import math
+import sqlite3
+
+import chess
+import chess.engine
+
+from analysiscache import signed_key
+from archive import GameArchive
+from engines import EngineSession
+
+# Scores beyond this are treated as this (mates included) when measuring loss
+CP_CAP = 1000
+
+parser = argparse.ArgumentParser(
+    description="Analyse the games in a vote chess archive")
+parser.add_argument(help="Config file (json); its engine block is used for "
+                    "the analysis", dest="config_file")
+parser.add_argument("--archive", dest="archive",
+                    help="PGN archive to analyse (default: the config's archive_file)")
+parser.add_argument("-o", "--output", dest="output",
+                    help="Results file (sqlite, default: <archive>.analysis)")
+parser.add_argument("--depth", type=int, default=16, dest="depth",
+                    help="Search depth per position (default: 16)")
+parser.add_argument("--pool-size", type=int, dest="pool_size",
+                    help="Engine processes (default: the config's pool_size)")
+parser.add_argument("--batch", type=int, default=16, dest="batch",
+                    help="Games analysed between checkpoints (default: 16)")
+parser.add_argument("--report", action="store_true", dest="report",
+                    help="Print the stored results rather than analysing")
+
+SIDES = ("human", "engine")
+STATS = ("moves", "accuracy", "acpl", "inaccuracies", "mistakes", "blunders",
+         "top_choice")
+
+
+def win_percent(cp):
+    # Expected score (0-100) for the side with a `cp` advantage, as used by
+    # lichess for its accuracy figures
+    cp = max(-CP_CAP, min(CP_CAP, cp))
+    return 50 + 50 * (2 / (1 + math.exp(-0.00368208 * cp)) - 1)
+
+
+def move_accuracy(before, after):
+    # 0-100, from the mover's win percentage before and after the move
+    acc = 103.1668 * math.exp(-0.04354 * (before - after)) - 3.1669
+    return max(0.0, min(100.0, acc))
+
+
+def terminal_score(board):
+    # Score (for the side to move) of a finished game, or None
+    if board.is_checkmate():
+        return (chess.engine.Mate(0), None)
+    if board.is_game_over():
+        return (chess.engine.Cp(0), None)
+    return None
+
+
+class AnalysisStore:
+    """Searched positions and per-game results for one archive.
+
+    Positions are keyed by Zobrist hash and depth, so a position reached in
+    several games (or again in a later run) is searched once. A game's row
+    is only written once all its positions are stored, and both are
+    committed together: a game with a row is finished.
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS positions ("
+                         "key INTEGER, depth INTEGER, cp INTEGER, mate INTEGER, "
+                         "move TEXT, PRIMARY KEY (key, depth))")
+        columns = ", ".join("{}_{} REAL".format(side, stat)
+                            for side in SIDES for stat in STATS)
+        self._db.execute("CREATE TABLE IF NOT EXISTS games ("
+                         "offset INTEGER, depth INTEGER, round INTEGER, "
+                         "date TEXT, result TEXT, human TEXT, plies INTEGER, "
+                         "analysed TEXT, " + columns + ", "
+                         "PRIMARY KEY (offset, depth))")
+        self._db.commit()
+
+    def done(self, depth):
+        return set(row[0] for row in self._db.execute(
+            "SELECT offset FROM games WHERE depth = ?", (depth,)))
+
+    def lookup(self, keys, depth):
+        # {key: (score, best move)} for the keys already searched
+        found = dict()
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            for (key, cp, mate, move) in self._db.execute(
+                    "SELECT key, cp, mate, move FROM positions WHERE depth = ? "
+                    "AND key IN ({})".format(",".join("?" * len(chunk))),
+                    [depth] + chunk):
+                score = (chess.engine.Cp(cp) if mate is None
+                         else chess.engine.Mate(mate))
+                found[key] = (score, None if move is None
+                              else chess.Move.from_uci(move))
+        return found
+
+    def add_positions(self, results, depth):
+        rows = []
+        for (key, (score, move)) in results.items():
+            if score.is_mate():
+                (cp, mate) = (None, score.mate())
+            else:
+                (cp, mate) = (score.score(), None)
+            rows.append((key, depth, cp, mate,
+                         None if move is None else move.uci()))
+        self._db.executemany("INSERT OR REPLACE INTO positions "
+                             "VALUES (?, ?, ?, ?, ?)", rows)
+
+    def add_game(self, row):
+        self._db.execute("INSERT OR REPLACE INTO games ({}) VALUES ({})".format(
+            ", ".join(row), ", ".join("?" * len(row))), list(row.values()))
+
+    def commit(self):
+        self._db.commit()
+
+    def games(self):
+        cursor = self._db.execute("SELECT * FROM games ORDER BY offset, depth")
+        columns = [d[0] for d in cursor.description]
+        for row in cursor:
+            yield dict(zip(columns, row))
+
+    def close(self):
+        self._db.close()
+
+
+def positions(game):
+    # [(key, board before the move, move)] along the game's main line, ending
+    # with the final position and move None
+    board = game.board()
+    out = []
+    for mv in game.mainline_moves():
+        out.append((signed_key(board), board.copy(stack=False), mv))
+        board.push(mv)
+    out.append((signed_key(board), board, None))
+    return out
+
+
+def search_shard(limit):
+    def search(engine, shard):
+        results = dict()
+        for (key, board) in shard:
+            info = engine.analyse(board, limit)
+            pv = info.get("pv") or [None]
+            results[key] = (info["score"].relative, pv[0])
+        return results
+    return search
+
+
+def game_stats(game, plies, scores):
+    # Per-side figures for one game from the scores of its positions
+    human = (chess.BLACK if "(depth" in game.headers.get("White", "")
+             else chess.WHITE)
+    moves = {side: [] for side in SIDES}
+    for (i, (key, board, mv)) in enumerate(plies[:-1]):
+        (before, best) = scores[key]
+        (after, _) = scores[plies[i + 1][0]]
+        before = before.score(mate_score=CP_CAP)
+        # The next position is scored for the opponent
+        after = -after.score(mate_score=CP_CAP)
+        (wpBefore, wpAfter) = (win_percent(before), win_percent(after))
+        side = "human" if board.turn == human else "engine"
+        moves[side].append((max(0, min(CP_CAP, before) - max(-CP_CAP, after)),
+                            move_accuracy(wpBefore, wpAfter),
+                            wpBefore - wpAfter, mv == best))
+    row = {"human": "WHITE" if human == chess.WHITE else "BLACK"}
+    for side in SIDES:
+        played = moves[side]
+        n = len(played)
+        row[side + "_moves"] = n
+        row[side + "_accuracy"] = (sum(m[1] for m in played) / n) if n > 0 else None
+        row[side + "_acpl"] = (sum(m[0] for m in played) / n) if n > 0 else None
+        # Drops in win percentage, as lichess classifies them
+        row[side + "_inaccuracies"] = sum(1 for m in played if 5 <= m[2] < 10)
+        row[side + "_mistakes"] = sum(1 for m in played if 10 <= m[2] < 15)
+        row[side + "_blunders"] = sum(1 for m in played if m[2] >= 15)
+        row[side + "_top_choice"] = (sum(1 for m in played if m[3]) / n) if n > 0 else None
+    return row
+
+
+def analyse_batch(batch, store, session, limit, depth):
+    # Search the batch's new positions across the pool, then store them and
+    # the batch's game rows in one commit. Returns (searched, reused).
+    games = [(entry, game, positions(game)) for (entry, game) in batch]
+    scores = dict()
+    pending = dict()
+    for (_, _, plies) in games:
+        for (key, board, _) in plies:
+            if key in scores or key in pending:
+                continue
+            terminal = terminal_score(board)
+            if terminal is not None:
+                scores[key] = terminal
+            else:
+                pending[key] = board
+    known = store.lookup(pending, depth)
+    scores.update(known)
+    todo = [(key, board) for (key, board) in pending.items() if key not in known]
+    if len(todo) > 0:
+        shards = [todo[i::session.size] for i in range(min(session.size, len(todo)))]
+        searched = dict()
+        for results in session.map(search_shard(limit), shards):
+            searched.update(results)
+        store.add_positions(searched, depth)
+        scores.update(searched)
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    for (entry, game, plies) in games:
+        row = {"offset": entry["offset"], "depth": depth,
+               "round": entry["round"], "date": entry["date"],
+               "result": entry["result"], "plies": len(plies) - 1,
+               "analysed": now}
+        row.update(game_stats(game, plies, scores))
+        store.add_game(row)
+    store.commit()
+    return (len(todo), len(pending) - len(todo))
+
+
+def report(store):
+    print("round\tdate\tresult\thuman\tdepth\thuman acc\tengine acc\t"
+          "human acpl\tblunders\ttop choice")
+    for row in store.games():
+        print("{round}\t{date}\t{result}\t{human}\t{depth}\t{0}\t{1}\t{2}\t"
+              "{human_blunders:.0f}\t{3}".format(
+                  *("-" if v is None else "{:.1f}".format(v) for v in (
+                      row["human_accuracy"], row["engine_accuracy"],
+                      row["human_acpl"],
+                      None if row["human_top_choice"] is None
+                      else 100 * row["human_top_choice"])), **row))
+
+
+def main():
+    args = parser.parse_args()
+    with open(args.config_file, "r") as configfile:
+        config = json.load(configfile)
+    archivefp = args.archive or config["archive_file"]
+    store = AnalysisStore(args.output or archivefp + ".analysis")
+    if args.report:
+        report(store)
+        store.close()
+        return
+    archive = GameArchive(archivefp)
+    engine_config = dict(config["engine"])
+    if args.pool_size is not None:
+        engine_config["pool_size"] = args.pool_size
+    session = EngineSession(engine_config)
+    limit = chess.engine.Limit(depth=args.depth)
+    done = store.done(args.depth)
+    entries = [e for e in archive.find() if e["offset"] not in done]
+    print("{} games to analyse ({} already done) on {} engine processes".format(
+        len(entries), len(done), session.size))
+    (analysed, searched, reused) = (0, 0, 0)
+    try:
+        for i in range(0, len(entries), args.batch):
+            batch = [(entry, archive.read(entry["offset"], entry["length"]))
+                     for entry in entries[i:i + args.batch]]
+            batch = [(entry, game) for (entry, game) in batch if game is not None]
+            (s, r) = analyse_batch(batch, store, session, limit, args.depth)
+            analysed += len(batch)
+            searched += s
+            reused += r
+            print("{}/{} games, {} positions searched, {} reused".format(
+                analysed, len(entries), searched, reused))
+    except KeyboardInterrupt:
+        print("Interrupted; {} games saved, run again to resume".format(analysed))
+    finally:
+        session.close()
+        archive.close()
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import sqlite3
+import threading
+
+import chess.engine
+import chess.polyglot
+
+
+def signed_key(board):
+    # The board's Zobrist hash as an sqlite integer: those are signed 64-bit,
+    # Zobrist hashes are unsigned
+    key = chess.polyglot.zobrist_hash(board)
+    return key - (1 << 64) if key >= (1 << 63) else key
+
+
+class AnalysisCache:
+    """Persistent engine analysis keyed by Zobrist hash, engine and depth.
+
+    Each entry holds the score (relative to the side to move) and best move
+    found by a fixed-depth search of a position. The store is a local sqlite
+    file shared between runs and bot instances, in WAL mode so readers never
+    wait on a writer. New entries are written and committed ``batch_size``
+    at a time; lookups only read, and the recency of the entries they hit is
+    written by flush(), which also trims the store back to ``max_entries``
+    least recently used entries. A store locked by another process for more
+    than ``busy_timeout`` seconds reads as a miss, and writes wait for the
+    next batch.
+    """
+
+    def __init__(self, path, engine_name, max_entries=100000, batch_size=64,
+                 busy_timeout=5.0):
+        self.engine_name = engine_name
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Entries not yet written, and hit entries' new recency
+        self._pending = dict()
+        self._used = dict()
+        # After a failed write, wait for another batch before retrying
+        self._write_at = batch_size
+        # Candidate rating looks positions up from the engine pool threads
+        self._db = sqlite3.connect(path, timeout=busy_timeout,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA busy_timeout = {:d}".format(int(busy_timeout * 1000)))
+        self._db.execute("CREATE TABLE IF NOT EXISTS analysis ("
+                         "key INTEGER, engine TEXT, depth INTEGER, "
+                         "cp INTEGER, mate INTEGER, move TEXT, used INTEGER, "
+                         "PRIMARY KEY (key, engine, depth))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS analysis_used "
+                         "ON analysis (used)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS stats ("
+                         "name TEXT PRIMARY KEY, value INTEGER)")
+        self._db.commit()
+        self._clock = self._db.execute(
+            "SELECT COALESCE(MAX(used), 0) FROM analysis").fetchone()[0]
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def get(self, board, depth):
+        # Returns (score, best move) or None; best move may itself be None
+        if depth is None:
+            return None
+        key = (signed_key(board), self.engine_name,
+               depth)
+        with self._lock:
+            row = self._pending.get(key)
+            if row is None:
+                try:
+                    row = self._db.execute(
+                        "SELECT cp, mate, move FROM analysis "
+                        "WHERE key = ? AND engine = ? AND depth = ?",
+                        key).fetchone()
+                except sqlite3.OperationalError as e:
+                    print("Failed to read analysis cache")
+                    print(e)
+                    row = None
+                if row is not None:
+                    self._used[key] = self._tick()
+            else:
+                row = row[:3]
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        (cp, mate, move) = row
+        score = chess.engine.Cp(cp) if mate is None else chess.engine.Mate(mate)
+        return (score, None if move is None else chess.Move.from_uci(move))
+
+    def put(self, board, depth, score, move=None):
+        if depth is None:
+            return
+        if score.is_mate():
+            (cp, mate) = (None, score.mate())
+        else:
+            (cp, mate) = (score.score(), None)
+        key = (signed_key(board), self.engine_name,
+               depth)
+        with self._lock:
+            self._pending[key] = (cp, mate, None if move is None else move.uci(),
+                                  self._tick())
+            if len(self._pending) >= self._write_at:
+                self._write()
+
+    def _write(self):
+        # Write and commit the pending entries and recency updates; on a
+        # locked store they are kept for the next attempt. Holds self._lock.
+        try:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [key + row for (key, row) in self._pending.items()])
+            self._db.executemany(
+                "UPDATE analysis SET used = ? "
+                "WHERE key = ? AND engine = ? AND depth = ?",
+                [(used,) + key for (key, used) in self._used.items()])
+            self._db.commit()
+        except sqlite3.OperationalError as e:
+            self._db.rollback()
+            print("Failed to write analysis cache")
+            print(e)
+            self._write_at = len(self._pending) + self.batch_size
+            return False
+        self._pending.clear()
+        self._used.clear()
+        self._write_at = self.batch_size
+        return True
+
+    def flush(self):
+        with self._lock:
+            if not self._write():
+                return
+            try:
+                count = self._db.execute(
+                    "SELECT COUNT(*) FROM analysis").fetchone()[0]
+                if count > self.max_entries:
+                    self._db.execute(
+                        "DELETE FROM analysis WHERE rowid IN (SELECT rowid FROM "
+                        "analysis ORDER BY used LIMIT ?)",
+                        (count - self.max_entries,))
+                for (name, value) in (("hits", self.hits), ("misses", self.misses)):
+                    self._db.execute(
+                        "INSERT OR IGNORE INTO stats VALUES (?, 0)", (name,))
+                    self._db.execute(
+                        "UPDATE stats SET value = value + ? WHERE name = ?",
+                        (value, name))
+                self._db.commit()
+            except sqlite3.OperationalError as e:
+                self._db.rollback()
+                print("Failed to trim analysis cache")
+                print(e)
+                return
+            (self.hits, self.misses) = (0, 0)
+
+    def totals(self):
+        # Lifetime hit and miss counts, including any not yet flushed
+        with self._lock:
+            try:
+                stats = dict(self._db.execute("SELECT name, value FROM stats"))
+            except sqlite3.OperationalError:
+                stats = dict()
+        return (stats.get("hits", 0) + self.hits,
+                stats.get("misses", 0) + self.misses)
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+_caches = dict()
+
+
+def open_cache(cache_config, engine_name):
+    # One connection per cache file and engine, shared by every game using it
+    key = (cache_config.get("path"), engine_name)
+    cache = _caches.get(key)
+    if cache is None:
+        cache = AnalysisCache(cache_config.get("path"), engine_name,
+                              cache_config.get("max_entries", 100000),
+                              cache_config.get("batch_size", 64),
+                              cache_config.get("busy_timeout", 5.0))
+        _caches[key] = cache
+    return cache
+
+
+def close_caches():
+    for cache in _caches.values():
+        cache.close()
+    _caches.clear()
@@ -0,0 +1,208 @@
+import argparse
+import io
+import os
+import re
+import sqlite3
+import threading
+
+import chess.pgn
+
+DEPTH = re.compile(r"\(depth (\d+)\)")
+
+
+def _engine_depth(headers):
+    for side in ("White", "Black"):
+        m = DEPTH.search(headers.get(side, ""))
+        if m is not None:
+            return int(m.group(1))
+    return None
+
+
+def _round(headers):
+    try:
+        return int(headers.get("Round"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _scan(pgnfile):
+    # Yield (offset, length, headers) for each game in a binary PGN file.
+    # A game starts at a tag line that follows movetext (or the start of
+    # the file); only the tag pairs are parsed.
+    offset = None
+    headers = {}
+    in_moves = False
+    pos = 0
+    for line in pgnfile:
+        stripped = line.strip()
+        if stripped.startswith(b"["):
+            if offset is None or in_moves:
+                if offset is not None:
+                    yield (offset, pos - offset, headers)
+                (offset, headers, in_moves) = (pos, {}, False)
+            m = re.match(rb'\[(\w+)\s+"(.*)"\]', stripped)
+            if m is not None:
+                headers[m.group(1).decode("utf-8")] = m.group(2).decode(
+                    "utf-8").replace('\\"', '"')
+        elif stripped and offset is not None:
+            in_moves = True
+        pos += len(line)
+    if offset is not None:
+        yield (offset, pos - offset, headers)
+
+
+class GameArchive:
+    """A PGN archive with an sqlite offset index beside it.
+
+    The index (``<archive>.idx``) records each game's byte offset and length
+    with its round, result, date and engine depth, so lookups seek straight
+    to the record. Iteration reads one game at a time and never holds the
+    file in memory. An index that is missing or behind the PGN file is
+    rebuilt from the file.
+    """
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or path + ".idx"
+        self._db = sqlite3.connect(self.index_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute("CREATE TABLE IF NOT EXISTS games ("
+                         "offset INTEGER PRIMARY KEY, length INTEGER, "
+                         "round INTEGER, result TEXT, date TEXT, "
+                         "engine_depth INTEGER, white TEXT, black TEXT)")
+        for column in ("round", "result", "date", "engine_depth"):
+            self._db.execute("CREATE INDEX IF NOT EXISTS games_{0} "
+                             "ON games ({0})".format(column))
+        self._db.commit()
+        if self._indexed_to() != self._size():
+            self.build_index()
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def _indexed_to(self):
+        return self._db.execute("SELECT COALESCE(MAX(offset + length), 0) "
+                                "FROM games").fetchone()[0]
+
+    def _insert(self, offset, length, headers):
+        self._db.execute(
+            "INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (offset, length, _round(headers), headers.get("Result"),
+             headers.get("Date"), _engine_depth(headers),
+             headers.get("White"), headers.get("Black")))
+
+    def build_index(self):
+        # Import: (re)index every game already in the PGN file
+        self._db.execute("DELETE FROM games")
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as pgnfile:
+                for (offset, length, headers) in _scan(pgnfile):
+                    self._insert(offset, length, headers)
+        self._db.commit()
+
+    def append(self, game):
+        record = (str(game) + "\n\n").encode("utf-8")
+        with self._lock:
+            with open(self.path, "ab") as pgnfile:
+                offset = pgnfile.seek(0, os.SEEK_END)
+                pgnfile.write(record)
+            self._insert(offset, len(record), game.headers)
+            self._db.commit()
+
+    def read(self, offset, length):
+        with open(self.path, "rb") as pgnfile:
+            pgnfile.seek(offset)
+            text = pgnfile.read(length).decode("utf-8")
+        return chess.pgn.read_game(io.StringIO(text))
+
+    def find(self, round=None, result=None, date=None, engine_depth=None):
+        # Index rows (as dicts) matching every given key, in archive order
+        keys = {"round": round, "result": result, "date": date,
+                "engine_depth": engine_depth}
+        where = [(k, v) for (k, v) in keys.items() if v is not None]
+        sql = "SELECT * FROM games"
+        if len(where) > 0:
+            sql += " WHERE " + " AND ".join("{} = ?".format(k) for (k, _) in where)
+        with self._lock:
+            cursor = self._db.execute(sql + " ORDER BY offset",
+                                      [v for (_, v) in where])
+            columns = [d[0] for d in cursor.description]
+            rows = cursor.fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def games(self, **keys):
+        # Stream the games matching `keys` (all of them by default)
+        if len(keys) == 0:
+            with open(self.path, "r") as pgnfile:
+                game = chess.pgn.read_game(pgnfile)
+                while game is not None:
+                    yield game
+                    game = chess.pgn.read_game(pgnfile)
+            return
+        for row in self.find(**keys):
+            yield self.read(row["offset"], row["length"])
+
+    def __iter__(self):
+        return self.games()
+
+    def by_round(self, round):
+        for row in self.find(round=round):
+            return self.read(row["offset"], row["length"])
+        return None
+
+    def close(self):
+        self._db.close()
+
+
+_archives = dict()
+
+
+def open_archive(path):
+    # One index connection per archive file, shared by every game using it
+    archive = _archives.get(path)
+    if archive is None:
+        archive = GameArchive(path)
+        _archives[path] = archive
+    return archive
+
+
+def close_archives():
+    for archive in _archives.values():
+        archive.close()
+    _archives.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index a vote chess PGN archive and look games up")
+    parser.add_argument(help="Archive PGN file", dest="archive")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Rebuild the index from the PGN file")
+    parser.add_argument("--round", type=int, dest="round")
+    parser.add_argument("--result", dest="result")
+    parser.add_argument("--date", dest="date", help="PGN date, e.g. 2023.05.01")
+    parser.add_argument("--engine-depth", type=int, dest="engine_depth")
+    parser.add_argument("--pgn", action="store_true",
+                        help="Print the matching games rather than a summary")
+    args = parser.parse_args()
+    archive = GameArchive(args.archive)
+    if args.rebuild:
+        archive.build_index()
+    keys = {"round": args.round, "result": args.result, "date": args.date,
+            "engine_depth": args.engine_depth}
+    rows = archive.find(**keys)
+    for row in rows:
+        if args.pgn:
+            print(archive.read(row["offset"], row["length"]), end="\n\n")
+        else:
+            print("{round}\t{date}\t{result}\t{white} - {black}".format(**row))
+    if not args.pgn:
+        print("{} games".format(len(rows)))
+    archive.close()
+
+
+if __name__ == "__main__":
+    main()
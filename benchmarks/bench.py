@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# Micro-benchmarks for the turn pipeline, run against the stub engine in
+# this directory and a local fake of the Mastodon and tablebase APIs, so no
+# Stockfish binary or live account is needed. Each benchmark runs in its own
+# child process, so its peak RSS is its own. Results are written as JSON;
+# --compare flags benchmarks that got slower than a saved run.
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from random import Random
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import chess
+import chess.engine
+import chess.polyglot
+
+import votechess
+import tablebase
+from engines import close_sessions
+from analysiscache import close_caches
+from openingbook import close_books
+from tablebase import close_tablebases
+from archive import close_archives
+from gamestate import GameStore
+from render import sprite_renderer
+from fakeserver import FakeServer
+
+STUB_ENGINE = os.path.join(BENCH_DIR, "stubfish.py")
+
+# Each phase is a start position and a number of (seeded random) plies
+# played from it, so load_game has a history of that length to replay
+PHASES = {
+    "opening": (chess.STARTING_FEN, 6),
+    "middlegame": ("r1bq1rk1/pp2bppp/2n1pn2/2pp4/3P4/2PBPN2/PP1N1PPP/R2QK2R w KQ - 0 9", 30),
+    "endgame": ("8/5pk1/R5p1/8/5P2/6P1/5K2/r7 w - - 0 40", 60),
+}
+
+parser = argparse.ArgumentParser(description="Vote chess micro-benchmarks")
+parser.add_argument("--repeat", type=int, default=5, dest="repeat",
+                    help="Timed runs per benchmark (default: 5)")
+parser.add_argument("--depth", type=int, default=8, dest="depth",
+                    help="Engine and human search depth (default: 8)")
+parser.add_argument("--pool-size", type=int, default=2, dest="pool_size",
+                    help="Engine processes (default: 2)")
+parser.add_argument("--phases", nargs="+", default=list(PHASES),
+                    choices=list(PHASES), dest="phases")
+parser.add_argument("--only", nargs="+", dest="only",
+                    help="Run only the benchmarks with these names")
+parser.add_argument("-o", "--output", default="bench-results.json",
+                    dest="output", help="Results file (JSON)")
+parser.add_argument("--compare", dest="compare",
+                    help="Earlier results file to check for regressions")
+parser.add_argument("--threshold", type=float, default=0.25, dest="threshold",
+                    help="Relative slowdown of the median counted as a "
+                    "regression (default: 0.25)")
+# Internal: run one benchmark and print its result as JSON
+parser.add_argument("--child", nargs=2, metavar=("PHASE", "NAME"),
+                    dest="child", help=argparse.SUPPRESS)
+
+# The benchmarks made by benchmarks(), in order
+NAMES = ("eng_rate[per-move]", "eng_rate[multipv]", "opening_choice",
+         "print_board", "print_board[cached]", "load_game", "turn")
+
+
+def phase_board(name):
+    (fen, plies) = PHASES[name]
+    board = chess.Board(fen)
+    rng = Random(name)
+    for _ in range(plies):
+        moves = sorted(board.legal_moves, key=lambda m: m.uci())
+        # Keep the game going: skip moves that would end it
+        rng.shuffle(moves)
+        for mv in moves:
+            board.push(mv)
+            if not board.is_game_over(claim_draw=True):
+                break
+            board.pop()
+        else:
+            break
+    return board
+
+
+def write_book(path, boards):
+    # A small polyglot book: the first four non-castling moves (by UCI) of
+    # every position along each board's history
+    entries = set()
+    for board in boards:
+        replay = board.root()
+        for mv in board.move_stack + [None]:
+            key = chess.polyglot.zobrist_hash(replay)
+            candidates = sorted((m for m in replay.legal_moves
+                                 if not replay.is_castling(m)),
+                                key=lambda m: m.uci())[:4]
+            for (weight, m) in enumerate(candidates, 1):
+                raw = (m.to_square | m.from_square << 6
+                       | (m.promotion - 1 if m.promotion else 0) << 12)
+                entries.add((key, raw, weight, 0))
+            if mv is not None:
+                replay.push(mv)
+    with open(path, "wb") as bookfile:
+        for entry in sorted(entries):
+            bookfile.write(struct.pack(">QHHI", *entry))
+
+
+class Bench:
+    # Holds the fake server, scratch directory and per-phase fixtures
+
+    def __init__(self, args, workdir):
+        self.args = args
+        self.workdir = workdir
+        self.server = FakeServer().start()
+        tablebase.LICHESS_API = self.server.url + "/standard"
+        self.boards = {name: phase_board(name) for name in args.phases}
+        self.book = os.path.join(workdir, "book.bin")
+        write_book(self.book, self.boards.values())
+        self.games = []
+
+    def config(self, board):
+        human = "WHITE" if board.turn == chess.WHITE else "BLACK"
+        return {
+            "name": "Bench",
+            "server": self.server.url,
+            "usercred": "bench-token",
+            "engine": {"name": "Stubfish", "path": STUB_ENGINE,
+                       "depth": self.args.depth, "score": 0.0,
+                       "pool_size": self.args.pool_size},
+            "human": {"name": "Bench", "depth": self.args.depth,
+                      "colour": human, "score": 0.0},
+            "site": "@bench@127.0.0.1",
+            "polyglot_book": self.book,
+            "tablebase_online": True,
+            "postid": None,
+            "round": 0,
+            "archive_file": os.path.join(self.workdir, "archive.pgn"),
+            "image_file": os.path.join(self.workdir, "board.png"),
+            "poll_length": 3600,
+            "show_arrows": True,
+            "renderer": "sprites",
+            "sprite_dir": os.path.join(self.workdir, "sprites"),
+        }
+
+    def game(self, board, poll=False):
+        # A fresh config and state file holding `board`; with poll=True, an
+        # open poll on the fake server for its first four moves
+        config = self.config(board)
+        configfp = os.path.join(self.workdir, "bench.json")
+        state = GameStore(os.path.splitext(configfp)[0] + ".state")
+        state.clear()
+        if poll:
+            options = [board.san(m) for m in
+                       sorted(board.legal_moves, key=lambda m: m.uci())[:4]]
+            config["postid"] = self.server.post_status("Bench", options)["id"]
+        state.start(board, config)
+        with open(configfp, "w") as configfile:
+            json.dump(config, configfile, indent=2)
+        args = votechess.parser.parse_args([configfp, "-d", self.workdir])
+        game = votechess.VoteChessGame(configfp, args)
+        game.limithuman = chess.engine.Limit(depth=self.args.depth)
+        game.limitengine = chess.engine.Limit(depth=self.args.depth)
+        game.player = board.turn
+        self.games.append(game)
+        return game
+
+    def close(self):
+        for game in self.games:
+            game.close()
+        self.server.close()
+
+
+def current_rss_kb():
+    # Resident set size now, rather than the high-water mark
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(fn, setup=None, repeat=5, warmup=1):
+    # Wall times of `repeat` runs after `warmup` untimed ones, then one more
+    # run under tracemalloc for its allocations. setup() runs untimed before
+    # each run and its result is passed to fn. The RSS figures are the
+    # process's peak, and how far it rose above the RSS at the start.
+    start_rss = current_rss_kb()
+    times = []
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        for i in range(warmup + repeat):
+            state = setup() if setup is not None else None
+            start = time.perf_counter()
+            fn(state)
+            elapsed = time.perf_counter() - start
+            if i >= warmup:
+                times.append(elapsed)
+        state = setup() if setup is not None else None
+        tracemalloc.start()
+        try:
+            fn(state)
+            (current, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {
+        "runs": repeat,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.mean(times),
+        "stdev_s": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "alloc_peak_kb": round(peak / 1024, 1),
+        "alloc_net_kb": round(current / 1024, 1),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "rss_growth_kb": max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                             - start_rss),
+    }
+
+
+def benchmarks(bench, phase):
+    # (name, setup, fn) for one phase
+    board = bench.boards[phase]
+    lim = chess.engine.Limit(depth=bench.args.depth)
+    game = bench.game(board)
+    session = game.engine_session
+    legmoves = list(board.legal_moves)
+    renderer = sprite_renderer(game.args.scale, game.config.get("board_colours"),
+                               game.config.get("sprite_dir"))
+    options = legmoves[:4]
+
+    def uncached_render():
+        renderer._cache.clear()
+
+    return [
+        ("eng_rate[per-move]", None,
+         lambda _: votechess.eng_rate(legmoves, board, session, lim)),
+        ("eng_rate[multipv]", None,
+         lambda _: votechess.eng_rate(legmoves, board, session, lim, 0)),
+        ("opening_choice", None,
+         lambda _: votechess.opening_choice(board, bench.book, 4)),
+        ("print_board", lambda: uncached_render(),
+         lambda _: game.print_board(board, options)),
+        ("print_board[cached]", None,
+         lambda _: game.print_board(board, options)),
+        ("load_game", lambda: bench.game(board), lambda g: g.load_game()),
+        ("turn", lambda: bench.game(board, poll=True),
+         lambda g: (g.run_turn(), g.posts.submit(lambda: None).result())),
+    ]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "-C", REPO_DIR, "describe", "--always",
+                               "--dirty"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    # Returns the (name, phase, old, new) medians that slowed down by more
+    # than `threshold`
+    with open(baseline_path, "r") as basefile:
+        baseline = json.load(basefile)
+    old = {(r["name"], r["phase"]): r["median_s"]
+           for r in baseline["results"] if "median_s" in r}
+    slower = []
+    for r in results:
+        key = (r["name"], r["phase"])
+        if "median_s" in r and key in old and r["median_s"] > old[key] * (1 + threshold):
+            slower.append((r["name"], r["phase"], old[key], r["median_s"]))
+    return slower
+
+
+def run_child(args):
+    # In a fresh process: set up the fixtures, run one benchmark, and print
+    # its result and the fake server's request counts as JSON
+    (phase, name) = args.child
+    args.phases = [phase]
+    with tempfile.TemporaryDirectory(prefix="votechess-bench-") as workdir:
+        bench = Bench(args, workdir)
+        result = {"error": "unknown benchmark"}
+        try:
+            for (bname, setup, fn) in benchmarks(bench, phase):
+                if bname == name:
+                    try:
+                        result = measure(fn, setup, args.repeat)
+                    except Exception as e:
+                        result = {"error": "{}: {}".format(type(e).__name__, e)}
+            requests_made = dict(bench.server.requests)
+        finally:
+            bench.close()
+            close_sessions()
+            close_books()
+            close_caches()
+            close_tablebases()
+            close_archives()
+    print(json.dumps({"result": result, "http_requests": requests_made}))
+
+
+def run_benchmark(args, phase, name):
+    argv = [sys.executable, os.path.abspath(__file__), "--child", phase, name,
+            "--repeat", str(args.repeat), "--depth", str(args.depth),
+            "--pool-size", str(args.pool_size)]
+    try:
+        proc = subprocess.run(argv, capture_output=True, text=True, check=True)
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+    except (subprocess.CalledProcessError, ValueError, IndexError) as e:
+        stderr = getattr(e, "stderr", None) or ""
+        error = stderr.strip().splitlines()[-1] if stderr.strip() else str(e)
+        return {"result": {"error": error}, "http_requests": {}}
+
+
+def main():
+    args = parser.parse_args()
+    if args.child is not None:
+        run_child(args)
+        return
+    results = []
+    requests_made = dict()
+    for phase in args.phases:
+        board = phase_board(phase)
+        for name in NAMES:
+            if args.only is not None and name not in args.only:
+                continue
+            result = {"name": name, "phase": phase,
+                      "legal_moves": board.legal_moves.count(),
+                      "plies": len(board.move_stack),
+                      "pieces": len(board.piece_map())}
+            child = run_benchmark(args, phase, name)
+            result.update(child["result"])
+            for (request, n) in child["http_requests"].items():
+                requests_made[request] = requests_made.get(request, 0) + n
+            results.append(result)
+            if "error" in result:
+                print("{:<22} {:<10} failed: {}".format(
+                    name, phase, result["error"]))
+            else:
+                print("{:<22} {:<10} {:>9.2f} ms  {:>9.1f} KiB peak  "
+                      "{:>7} KiB RSS (+{})".format(
+                          name, phase, result["median_s"] * 1000,
+                          result["alloc_peak_kb"], result["peak_rss_kb"],
+                          result["rss_growth_kb"]))
+    report = {
+        "revision": git_revision(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"repeat": args.repeat, "depth": args.depth,
+                     "pool_size": args.pool_size},
+        "http_requests": requests_made,
+        "results": results,
+    }
+    with open(args.output, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    print("Results written to {}".format(args.output))
+    if args.compare is not None:
+        slower = compare(results, args.compare, args.threshold)
+        for (name, phase, old, new) in slower:
+            print("Regression: {} ({}) {:.2f} ms -> {:.2f} ms".format(
+                name, phase, old * 1000, new * 1000))
+        if len(slower) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
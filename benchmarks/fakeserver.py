@@ -0,0 +1,136 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import datetime
+import itertools
+import json
+import threading
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeServer:
+    """A local HTTP stand-in for the Mastodon and lichess tablebase APIs.
+
+    Implements just the endpoints the bot calls: instance info, media
+    upload and lookup, and status post and fetch, plus the tablebase's
+    ``/standard``. Statuses are kept in memory. A poll's votes are fixed by
+    its options, with the first two tied, so every run sees the same result.
+    Counts every request by endpoint in ``requests``.
+    """
+
+    def __init__(self, version="4.1.0"):
+        self.version = version
+        self.statuses = dict()
+        self.requests = dict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self._httpd.server_address[1])
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _next_id(self):
+        with self._lock:
+            return str(next(self._ids))
+
+    def post_status(self, text, options=None, expires_in=3600):
+        # Also used directly, to seed the poll a benchmarked turn will count
+        now = datetime.datetime.now(datetime.timezone.utc)
+        status = {"id": self._next_id(), "created_at": now.isoformat(),
+                  "content": text, "poll": None}
+        if options is not None:
+            expires = now + datetime.timedelta(seconds=int(expires_in))
+            status["poll"] = {
+                "id": status["id"], "expires_at": expires.isoformat(),
+                "expired": False, "multiple": False,
+                "options": [{"title": title,
+                             "votes_count": 2 if i < 2 else 0}
+                            for (i, title) in enumerate(options)]}
+        with self._lock:
+            self.statuses[status["id"]] = status
+        return status
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, code, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _count(self, method, path):
+                endpoint = "/".join("{id}" if part.isdigit() else part
+                                    for part in path.split("/"))
+                key = "{} {}".format(method, endpoint)
+                with server._lock:
+                    server.requests[key] = server.requests.get(key, 0) + 1
+
+            def _form(self):
+                # JSON bodies as they are; form bodies as {key: value}
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("application/json"):
+                    return json.loads(body or b"{}")
+                if content_type.startswith("application/x-www-form-urlencoded"):
+                    return {k: v[0] for (k, v) in
+                            parse_qs(body.decode("utf-8")).items()}
+                return dict()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                self._count("GET", url.path)
+                parts = url.path.strip("/").split("/")
+                if url.path.rstrip("/") == "/api/v1/instance":
+                    self._reply(200, {"uri": "127.0.0.1",
+                                      "version": server.version})
+                elif url.path == "/standard":
+                    # Every position is a cursed win: never adjudicated
+                    self._reply(200, {"category": "cursed-win", "wdl": 1,
+                                      "moves": []})
+                elif parts[:3] == ["api", "v1", "media"] and len(parts) == 4:
+                    self._reply(200, {"id": parts[3], "type": "image",
+                                      "url": "/media/" + parts[3]})
+                elif parts[:3] == ["api", "v1", "statuses"] and len(parts) == 4:
+                    status = server.statuses.get(parts[3])
+                    if status is None:
+                        self._reply(404, {"error": "Record not found"})
+                    else:
+                        self._reply(200, status)
+                else:
+                    self._reply(404, {"error": "Not found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                self._count("POST", url.path)
+                form = self._form()
+                if url.path in ("/api/v1/media", "/api/v2/media"):
+                    media_id = server._next_id()
+                    self._reply(200, {"id": media_id, "type": "image",
+                                      "url": "/media/" + media_id})
+                elif url.path == "/api/v1/statuses":
+                    poll = form.get("poll") or {}
+                    status = server.post_status(form.get("status", ""),
+                                                poll.get("options"),
+                                                poll.get("expires_in", 3600))
+                    self._reply(200, status)
+                else:
+                    self._reply(404, {"error": "Not found"})
+
+        return Handler
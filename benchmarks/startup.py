@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Startup-time benchmark: wall time of fresh interpreters importing the bot,
+# and running it on a path that stops before any turn is played, with the
+# heavy optional modules each one ends up loading. "cold" runs start with an
+# empty bytecode cache (so every module is compiled, as after an upgrade);
+# "warm" runs reuse a cache filled beforehand. Results are written as JSON in
+# bench.py's format, so --compare works the same way.
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from bench import REPO_DIR, STUB_ENGINE, compare, git_revision
+
+# Modules only some paths need; their presence after startup is reported
+HEAVY = ("mastodon", "requests", "numpy", "PIL", "cairosvg", "chess.syzygy")
+
+# Runs the bot's entry point with the given argv, then reports which heavy
+# modules were loaded on stderr
+PROBE = """
+import json, runpy, sys
+sys.argv = {argv!r}
+sys.path.insert(0, {repo!r})
+try:
+    {body}
+except SystemExit:
+    pass
+print(json.dumps(sorted(m for m in {heavy!r} if m in sys.modules)), file=sys.stderr)
+"""
+
+parser = argparse.ArgumentParser(description="Vote chess startup benchmark")
+parser.add_argument("--repeat", type=int, default=10, dest="repeat",
+                    help="Timed runs per scenario and cache state (default: 10)")
+parser.add_argument("-o", "--output", default="startup-results.json",
+                    dest="output", help="Results file (JSON)")
+parser.add_argument("--compare", dest="compare",
+                    help="Earlier results file to check for regressions")
+parser.add_argument("--threshold", type=float, default=0.25, dest="threshold",
+                    help="Relative slowdown of the median counted as a "
+                    "regression (default: 0.25)")
+
+
+def scenarios(workdir):
+    # (name, argv, body) for each startup path
+    config = os.path.join(workdir, "startup.json")
+    with open(config, "w") as configfile:
+        json.dump({"name": "Startup",
+                   "engine": {"name": "Stubfish", "path": STUB_ENGINE,
+                              "depth": 1, "score": 0.0},
+                   "human": {"name": "Startup", "depth": 1, "score": 0.0},
+                   "postid": None, "round": 0}, configfile)
+    script = os.path.join(REPO_DIR, "votechess.py")
+    run = "runpy.run_path({!r}, run_name='__main__')".format(script)
+    return [
+        ("import", ["votechess"], "import votechess"),
+        ("no_start_game", [script, config, "-d", workdir, "--debug",
+                           "--no-start-game"], run),
+    ]
+
+
+def run(code, env):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", code], env=env, cwd=REPO_DIR,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          text=True, check=True)
+    elapsed = time.perf_counter() - start
+    return (elapsed, json.loads(proc.stderr.strip().splitlines()[-1]))
+
+
+def measure(code, repeat, cold, workdir):
+    times = []
+    warm_cache = tempfile.mkdtemp(prefix="pycache-", dir=workdir)
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=warm_cache)
+    # Warm runs need the cache written
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    if not cold:
+        run(code, env)
+    for _ in range(repeat):
+        if cold:
+            env["PYTHONPYCACHEPREFIX"] = tempfile.mkdtemp(prefix="pycache-",
+                                                          dir=workdir)
+        (elapsed, loaded) = run(code, env)
+        times.append(elapsed)
+    return {
+        "runs": repeat,
+        "min_s": min(times),
+        "median_s": statistics.median(times),
+        "mean_s": statistics.mean(times),
+        "stdev_s": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "loaded": loaded,
+    }
+
+
+def main():
+    args = parser.parse_args()
+    results = []
+    with tempfile.TemporaryDirectory(prefix="votechess-startup-") as workdir:
+        # The interpreter alone, to subtract from the rest
+        baseline = ("python", [], "pass")
+        for (name, argv, body) in [baseline] + scenarios(workdir):
+            code = PROBE.format(argv=argv, repo=REPO_DIR, body=body,
+                                heavy=HEAVY)
+            for phase in ("cold", "warm"):
+                result = {"name": name, "phase": phase}
+                try:
+                    result.update(measure(code, args.repeat, phase == "cold",
+                                          workdir))
+                except (subprocess.CalledProcessError, ValueError, IndexError) as e:
+                    result["error"] = "{}: {}".format(type(e).__name__, e)
+                results.append(result)
+                if "error" in result:
+                    print("{:<14} {:<5} failed: {}".format(name, phase,
+                                                           result["error"]))
+                else:
+                    print("{:<14} {:<5} {:>9.1f} ms  loads: {}".format(
+                        name, phase, result["median_s"] * 1000,
+                        ", ".join(result["loaded"]) or "-"))
+    report = {
+        "revision": git_revision(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {"repeat": args.repeat},
+        "results": results,
+    }
+    with open(args.output, "w") as outfile:
+        json.dump(report, outfile, indent=2)
+    print("Results written to {}".format(args.output))
+    if args.compare is not None:
+        slower = compare(results, args.compare, args.threshold)
+        for (name, phase, old, new) in slower:
+            print("Regression: {} ({}) {:.1f} ms -> {:.1f} ms".format(
+                name, phase, old * 1000, new * 1000))
+        if len(slower) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# A deterministic stand-in for a UCI engine, for benchmarks. It scores each
+# root move by material and mobility after it and reports the requested
+# depth; the same position and options always give the same output.
+import sys
+
+import chess
+
+VALUES = {chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 300,
+          chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0}
+
+
+def evaluate(board):
+    # Relative to the side to move
+    if board.is_checkmate():
+        return None
+    score = board.legal_moves.count()
+    for piece in board.piece_map().values():
+        value = VALUES[piece.piece_type]
+        score += value if piece.color == board.turn else -value
+    return score
+
+
+def search(board, moves):
+    scored = []
+    for move in moves:
+        board.push(move)
+        sc = evaluate(board)
+        board.pop()
+        # From the mover's side: mate in one, or the negated reply score
+        scored.append((("mate", 1) if sc is None else ("cp", -sc), move.uci()))
+    scored.sort(key=lambda s: (s[0][0] != "mate", -s[0][1], s[1]))
+    return scored
+
+
+def main():
+    board = chess.Board()
+    multipv = 1
+    for line in sys.stdin:
+        tokens = line.split()
+        if len(tokens) == 0:
+            continue
+        if tokens[0] == "uci":
+            print("id name Stubfish")
+            print("option name MultiPV type spin default 1 min 1 max 500")
+            print("option name Threads type spin default 1 min 1 max 512")
+            print("option name Hash type spin default 16 min 1 max 33554432")
+            print("uciok", flush=True)
+        elif tokens[0] == "isready":
+            print("readyok", flush=True)
+        elif tokens[0] == "setoption" and tokens[2] == "MultiPV":
+            multipv = int(tokens[4])
+        elif tokens[0] == "position":
+            if tokens[1] == "startpos":
+                (board, rest) = (chess.Board(), tokens[2:])
+            else:
+                (board, rest) = (chess.Board(" ".join(tokens[2:8])), tokens[8:])
+            if len(rest) > 0 and rest[0] == "moves":
+                for uci in rest[1:]:
+                    board.push_uci(uci)
+        elif tokens[0] == "go":
+            depth = 1
+            if "depth" in tokens:
+                depth = int(tokens[tokens.index("depth") + 1])
+            moves = list(board.legal_moves)
+            if "searchmoves" in tokens:
+                moves = [chess.Move.from_uci(uci) for uci in
+                         tokens[tokens.index("searchmoves") + 1:]]
+            scored = search(board, moves)
+            if len(scored) == 0:
+                print("info depth 0 score mate 0")
+                print("bestmove (none)", flush=True)
+                continue
+            for (i, ((kind, value), uci)) in enumerate(scored[:multipv]):
+                print("info depth {} multipv {} score {} {} nodes {} pv {}".format(
+                    depth, i + 1, kind, value, len(moves) * depth, uci))
+            print("bestmove {}".format(scored[0][1]), flush=True)
+        elif tokens[0] == "quit":
+            break
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import chess.engine
+
+from metrics import count, propagate
+
+
+class Stopped(Exception):
+    """Raised by a search made after its :class:`StopSignal` was set."""
+
+
+class StopSignal:
+    """Cuts short the searches run under it, from any thread.
+
+    Searches made through :func:`stoppable_analyse` inside
+    ``with signal.applied():`` (and the pool workers it starts) are
+    registered here; :meth:`set` asks each running one to stop and makes
+    them, and any later ones, raise :class:`Stopped`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._set = False
+        self._running = set()
+
+    def is_set(self):
+        return self._set
+
+    def set(self):
+        with self._lock:
+            self._set = True
+            running = list(self._running)
+        for analysis in running:
+            analysis.stop()
+
+    def clear(self):
+        with self._lock:
+            self._set = False
+
+    @contextmanager
+    def applied(self):
+        token = _stop_signal.set(self)
+        try:
+            yield self
+        finally:
+            _stop_signal.reset(token)
+
+    @contextmanager
+    def _watching(self, analysis):
+        with self._lock:
+            self._running.add(analysis)
+            stopped = self._set
+        if stopped:
+            analysis.stop()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running.discard(analysis)
+
+
+_stop_signal = contextvars.ContextVar("stop_signal", default=None)
+
+
+def stoppable_analyse(engine, board, limit, **kwargs):
+    # engine.analyse(board, limit, **kwargs), unless a StopSignal applies:
+    # then the search is stopped as soon as it is set, and raises Stopped
+    # rather than return a half-finished result
+    signal = _stop_signal.get()
+    if signal is None:
+        return engine.analyse(board, limit, **kwargs)
+    if signal.is_set():
+        raise Stopped()
+    with engine.analysis(board, limit, **kwargs) as analysis:
+        with signal._watching(analysis):
+            analysis.wait()
+    if signal.is_set():
+        raise Stopped()
+    return analysis.info if kwargs.get("multipv") is None else analysis.multipv
+
+
+class EngineSession:
+    """A pool of UCI engine processes shared by everything in a run.
+
+    Processes are spawned on first use and configured once from the
+    ``options`` mapping of the engine config block (e.g. Threads, Hash), so
+    the tie-break, the engine reply and the candidate rating all search with
+    warm hash tables. ``pool_size`` in the same block caps the number of
+    processes (default: one per core). Games sharing a session take ``lock``
+    around their searches. Call close() when the run ends.
+    """
+
+    def __init__(self, engine_config):
+        self.path = engine_config.get("path")
+        self.options = engine_config.get("options") or {}
+        self.size = max(1, engine_config.get("pool_size") or os.cpu_count() or 1)
+        self._engines = []
+        self.lock = threading.RLock()
+
+    def _open(self):
+        engine = chess.engine.SimpleEngine.popen_uci(self.path)
+        count("engine_spawns")
+        if len(self.options) > 0:
+            engine.configure(self.options)
+        return engine
+
+    @property
+    def engine(self):
+        return self.pool(1)[0]
+
+    def pool(self, n=None):
+        # The first process is always the primary engine, so its hash stays
+        # warm for the engine reply
+        n = self.size if n is None else max(1, min(n, self.size))
+        # A process that has died (e.g. a crashed engine) is replaced, so a
+        # long-running daemon recovers on its next search
+        for (i, engine) in enumerate(self._engines[:n]):
+            if engine.protocol.returncode.done():
+                print("Engine process {} has terminated; restarting it".format(i))
+                engine.close()
+                self._engines[i] = self._open()
+        while len(self._engines) < n:
+            self._engines.append(self._open())
+        return self._engines[:n]
+
+    def map(self, fn, shards):
+        # Run fn(engine, shard) for each shard concurrently, one process per
+        # shard; results come back in shard order
+        if len(shards) > self.size:
+            raise ValueError("More shards ({}) than engines ({})".format(
+                len(shards), self.size))
+        with self.lock:
+            engines = self.pool(len(shards))
+            if len(engines) == 1:
+                return [fn(engines[0], shard) for shard in shards]
+            with ThreadPoolExecutor(max_workers=len(engines)) as executor:
+                return list(executor.map(propagate(fn), engines, shards))
+
+    def close(self):
+        for engine in self._engines:
+            try:
+                engine.quit()
+            except (chess.engine.EngineError,
+                    chess.engine.EngineTerminatedError) as e:
+                print("Failed to shut down engine cleanly")
+                print(e)
+                engine.close()
+        self._engines = []
+
+
+_sessions = dict()
+
+
+def shared_session(engine_config):
+    # Games whose engine blocks name the same binary, options and pool size
+    # share one session
+    key = (engine_config.get("path"),
+           tuple(sorted((engine_config.get("options") or {}).items())),
+           engine_config.get("pool_size"))
+    session = _sessions.get(key)
+    if session is None:
+        session = EngineSession(engine_config)
+        _sessions[key] = session
+    return session
+
+
+def close_sessions():
+    for session in _sessions.values():
+        session.close()
+    _sessions.clear()
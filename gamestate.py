@@ -0,0 +1,257 @@
+from array import array
+import base64
+import json
+import os
+import sys
+
+import chess
+import chess.polyglot
+
+_hasher = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+
+
+def pack_move(move):
+    # 16-bit move code: from square, to square, promotion piece type
+    return (move.from_square | (move.to_square << 6)
+            | ((move.promotion or 0) << 12))
+
+
+def unpack_move(code):
+    return chess.Move(code & 0x3f, (code >> 6) & 0x3f, (code >> 12) or None)
+
+
+def pack_moves(moves):
+    codes = array("H", [pack_move(move) for move in moves])
+    if codes.itemsize != 2:
+        raise ValueError("No 16-bit array type on this platform")
+    if sys.byteorder == "little":
+        codes.byteswap()
+    return base64.b64encode(codes.tobytes()).decode("ascii")
+
+
+def unpack_moves(packed):
+    codes = array("H")
+    codes.frombytes(base64.b64decode(packed))
+    if sys.byteorder == "little":
+        codes.byteswap()
+    return [unpack_move(code) for code in codes]
+
+
+def position_key(board):
+    # Zobrist hash of the position for repetition purposes: as polyglot, but
+    # with the en passant file only when the capture is legal (as in
+    # python-chess's own repetition checks)
+    key = _hasher(board)
+    if board.ep_square is not None and not board.has_legal_en_passant():
+        key ^= _hasher.hash_ep_square(board)
+    return key
+
+
+class GameTracker:
+    """Repetition counts for the game in progress, kept up to date as moves
+    are pushed.
+
+    ``counts`` holds how often each position (by :func:`position_key`) has
+    occurred since the last irreversible move, so the game-over and draw
+    checks look at the current position and its legal moves only, never the
+    move stack. With the halfmove clock (from the board) that covers every
+    ending the bot plays to: checkmate, stalemate, insufficient material,
+    the 75-move rule, fivefold repetition, and with ``claim_draw`` the
+    50-move rule and threefold repetition. Without ``counts`` they are
+    rebuilt once from the board's move stack.
+    """
+
+    def __init__(self, board, counts=None):
+        self.board = board
+        if counts is None:
+            counts = {position_key(board): 1}
+            replay = board.copy()
+            while len(replay.move_stack) > 0:
+                mv = replay.pop()
+                if replay.is_irreversible(mv):
+                    break
+                key = position_key(replay)
+                counts[key] = counts.get(key, 0) + 1
+        self.counts = counts
+        self._outcomes = dict()
+
+    def push(self, move):
+        if self.board.is_irreversible(move):
+            self.counts = dict()
+        self.board.push(move)
+        key = position_key(self.board)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self._outcomes = dict()
+
+    def copy(self):
+        return GameTracker(self.board.copy(), dict(self.counts))
+
+    def outcome(self, claim_draw=False):
+        # As chess.Board.outcome, for standard chess
+        if claim_draw not in self._outcomes:
+            self._outcomes[claim_draw] = self._outcome(claim_draw)
+        return self._outcomes[claim_draw]
+
+    def _outcome(self, claim_draw):
+        board = self.board
+        if board.is_checkmate():
+            return chess.Outcome(chess.Termination.CHECKMATE, not board.turn)
+        if board.is_insufficient_material():
+            return chess.Outcome(chess.Termination.INSUFFICIENT_MATERIAL, None)
+        if not any(board.generate_legal_moves()):
+            return chess.Outcome(chess.Termination.STALEMATE, None)
+        if board.halfmove_clock >= 150:
+            return chess.Outcome(chess.Termination.SEVENTYFIVE_MOVES, None)
+        occurred = self.counts.get(position_key(board), 0)
+        if occurred >= 5:
+            return chess.Outcome(chess.Termination.FIVEFOLD_REPETITION, None)
+        if claim_draw:
+            if board.can_claim_fifty_moves():
+                return chess.Outcome(chess.Termination.FIFTY_MOVES, None)
+            if occurred >= 3 or self._repeats_next():
+                return chess.Outcome(chess.Termination.THREEFOLD_REPETITION, None)
+        return None
+
+    def _repeats_next(self):
+        # Whether a legal move reaches a position for the third time
+        for mv in self.board.generate_legal_moves():
+            if self.board.is_irreversible(mv):
+                continue
+            self.board.push(mv)
+            try:
+                if self.counts.get(position_key(self.board), 0) >= 2:
+                    return True
+            finally:
+                self.board.pop()
+        return False
+
+    def is_game_over(self, claim_draw=False):
+        return self.outcome(claim_draw) is not None
+
+    def result(self, claim_draw=False):
+        outcome = self.outcome(claim_draw)
+        return "*" if outcome is None else outcome.result()
+
+    def pack(self):
+        return {"{:016x}".format(key): n for (key, n) in self.counts.items()}
+
+    @classmethod
+    def unpack(cls, board, packed):
+        return cls(board, {int(key, 16): n for (key, n) in packed.items()})
+
+
+class GameStore:
+    """Append-only state of the game in progress.
+
+    One JSON line per turn holds the moves played that turn as packed 16-bit
+    codes, the resulting FEN, the post and poll IDs, and the repetition
+    counts of a :class:`GameTracker`. The board is loaded by replaying the
+    codes, with no PGN parsing; PGN is only built when the game is
+    archived. Each record goes out in a single O_APPEND write, and a torn
+    last line (from a crash mid-write) is ignored on load. The file is read
+    once per store object; its own writes keep that copy current.
+    """
+
+    # Fields mirrored into the game config when a store is loaded
+    FIELDS = ("postid", "poll_options", "poll_expires", "mirror_ids")
+
+    def __init__(self, path):
+        self.path = path
+        self._loaded = None
+
+    def _records(self):
+        if self._loaded is None:
+            self._loaded = self._read()
+        return self._loaded
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as store:
+                lines = store.read().splitlines()
+        except FileNotFoundError:
+            return []
+        records = []
+        for (i, line) in enumerate(lines):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                if i == len(lines) - 1:
+                    break
+                raise
+        return records
+
+    def exists(self):
+        return len(self._records()) > 0
+
+    def load(self):
+        # Returns the current board with its full move stack, or None if no
+        # game is in progress
+        records = self._records()
+        if len(records) == 0:
+            return None
+        board = chess.Board(records[0].get("start", chess.STARTING_FEN))
+        for record in records:
+            for move in unpack_moves(record["moves"]):
+                board.push(move)
+        if board.fen() != records[-1]["fen"]:
+            raise ValueError("Game state {} is inconsistent: replay gives {}, "
+                             "saved {}".format(self.path, board.fen(),
+                                               records[-1]["fen"]))
+        return board
+
+    def tracker(self, board):
+        # A GameTracker for the loaded board, from the saved repetition
+        # counts if they are for this position
+        records = self._records()
+        if (len(records) > 0 and records[-1].get("repetitions") is not None
+                and records[-1]["fen"] == board.fen()):
+            return GameTracker.unpack(board, records[-1]["repetitions"])
+        return GameTracker(board)
+
+    def overlay(self, config):
+        # Copy the latest post and poll IDs into the config
+        records = self._records()
+        if len(records) > 0:
+            for field in self.FIELDS:
+                config[field] = records[-1].get(field)
+        return config
+
+    def _record(self, board, moves, config, tracker=None):
+        record = {"fen": board.fen(), "moves": pack_moves(moves)}
+        for field in self.FIELDS:
+            record[field] = config.get(field)
+        if tracker is not None:
+            record["repetitions"] = tracker.pack()
+        return record
+
+    def start(self, board, config, tracker=None):
+        # Begin a new game (replacing any old one) with the board so far
+        record = self._record(board, board.move_stack, config, tracker)
+        record["start"] = board.root().fen()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as store:
+            store.write(json.dumps(record, separators=(",", ":")) + "\n")
+            store.flush()
+            os.fsync(store.fileno())
+        os.replace(tmp, self.path)
+        self._loaded = [record]
+
+    def append(self, board, moves, config, tracker=None):
+        # Record one turn: the moves it added, the new position and IDs
+        record = self._record(board, moves, config, tracker)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(record, separators=(",", ":"))
+                          + "\n").encode("utf-8"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if self._loaded is not None:
+            self._loaded.append(record)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self._loaded = []
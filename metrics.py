@@ -0,0 +1,214 @@
+from contextlib import contextmanager
+import contextvars
+import datetime
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+# The turn being traced in this context, if any. Work handed to the engine
+# pool and the post queue runs in a copy of the caller's context, so its
+# spans land in the same turn.
+_current = contextvars.ContextVar("votechess_turn", default=None)
+_lock = threading.Lock()
+# (game, span) -> [count, total seconds], over the life of the process
+_spans = dict()
+# (name, labels) -> count
+_counters = dict()
+# game -> [turns, total seconds, failures, last finish (unix time)]
+_turns = dict()
+
+
+class Turn:
+    """The spans and counters recorded during one turn of one game.
+
+    Span times are offsets from the start of the turn. Anything recorded
+    after :meth:`close` (e.g. by a post still queued) only goes to the
+    process totals.
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.spans = []
+        self.counters = dict()
+        self.closed = False
+
+    def close(self, error=None):
+        self.duration = time.perf_counter() - self.start
+        self.error = error
+        self.closed = True
+
+    def record(self):
+        record = {"game": self.game, "start": self.started.isoformat(),
+                  "duration": round(self.duration, 6), "ok": self.error is None,
+                  "spans": self.spans, "counters": self.counters}
+        if self.error is not None:
+            record["error"] = self.error
+        return record
+
+
+@contextmanager
+def span(name, **attrs):
+    # Times the block. The yielded dict can take more attributes (e.g. the
+    # node count, once a search returns).
+    turn = _current.get()
+    start = time.perf_counter()
+    try:
+        yield attrs
+    finally:
+        duration = time.perf_counter() - start
+        with _lock:
+            if turn is not None and not turn.closed:
+                # Added to the totals when the turn ends
+                entry = {"name": name, "at": round(start - turn.start, 6),
+                         "duration": round(duration, 6)}
+                entry.update(attrs)
+                turn.spans.append(entry)
+            else:
+                _add_span(None if turn is None else turn.game, name, duration)
+
+
+def _add_span(game, name, duration):
+    # Call with _lock held
+    totals = _spans.setdefault((game, name), [0, 0.0])
+    totals[0] += 1
+    totals[1] += duration
+
+
+def count(name, n=1, **labels):
+    turn = _current.get()
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + n
+        if turn is not None and not turn.closed:
+            turn.counters[name] = turn.counters.get(name, 0) + n
+
+
+def _count_response(response, *args, **kwargs):
+    count("http_requests", host=urlparse(response.url).hostname or "")
+
+
+def hook_session(session):
+    # Counts every request made through a requests.Session
+    session.hooks["response"].append(_count_response)
+    return session
+
+
+def propagate(fn):
+    # fn, to run in a copy of the calling context (one copy per call, so it
+    # can be used for several concurrent tasks)
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+@contextmanager
+def before_turn(record=None):
+    # Holds the spans and counters recorded in the block (added to `record`,
+    # if given) for trace_turn to add to the next turn
+    record = Turn(None) if record is None else record
+    token = _current.set(record)
+    try:
+        yield record
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def trace_turn(game, trace_file=None, prometheus_file=None, before=None):
+    # Collects the spans of one turn, then appends them to `trace_file` as a
+    # JSON line and rewrites the process totals in `prometheus_file`.
+    # `before` is a before_turn record whose spans join this turn's, at
+    # negative offsets.
+    record = Turn(game)
+    if before is not None:
+        with _lock:
+            before.closed = True
+            record.spans = [dict(entry, at=round(before.start + entry["at"]
+                                                 - record.start, 6))
+                            for entry in before.spans]
+            record.counters = dict(before.counters)
+    token = _current.set(record)
+    error = None
+    try:
+        yield record
+    except BaseException as e:
+        error = "{}: {}".format(type(e).__name__, e)
+        raise
+    finally:
+        _current.reset(token)
+        with _lock:
+            record.close(error)
+            for entry in record.spans:
+                _add_span(game, entry["name"], entry["duration"])
+            totals = _turns.setdefault(game, [0, 0.0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += record.duration
+            totals[2] += 0 if error is None else 1
+            totals[3] = time.time()
+        try:
+            if trace_file is not None:
+                with open(trace_file, "a") as tracefile:
+                    print(json.dumps(record.record()), file=tracefile)
+            if prometheus_file is not None:
+                write_prometheus(prometheus_file)
+        except OSError as e:
+            print("Failed to write metrics")
+            print(e)
+
+
+def _labels(**labels):
+    items = []
+    for (k, v) in sorted(labels.items()):
+        v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        items.append('{}="{}"'.format(k, v))
+    return "{" + ",".join(items) + "}" if len(items) > 0 else ""
+
+
+def prometheus_text():
+    with _lock:
+        spans = sorted(_spans.items(), key=lambda kv: (kv[0][0] or "", kv[0][1]))
+        counters = sorted(_counters.items())
+        turns = sorted(_turns.items())
+    lines = ["# HELP votechess_turn_seconds Time taken by each turn",
+             "# TYPE votechess_turn_seconds summary"]
+    for (game, (n, total, _, _)) in turns:
+        lines.append("votechess_turn_seconds_sum{} {}".format(_labels(game=game), total))
+        lines.append("votechess_turn_seconds_count{} {}".format(_labels(game=game), n))
+    lines += ["# HELP votechess_turn_failures_total Turns that raised",
+              "# TYPE votechess_turn_failures_total counter"]
+    for (game, (_, _, failed, _)) in turns:
+        lines.append("votechess_turn_failures_total{} {}".format(_labels(game=game), failed))
+    lines += ["# HELP votechess_last_turn_timestamp_seconds When the last turn finished",
+              "# TYPE votechess_last_turn_timestamp_seconds gauge"]
+    for (game, (_, _, _, last)) in turns:
+        lines.append("votechess_last_turn_timestamp_seconds{} {}".format(_labels(game=game), last))
+    lines += ["# HELP votechess_span_seconds Time spent in each phase of a turn",
+              "# TYPE votechess_span_seconds summary"]
+    for ((game, name), (n, total)) in spans:
+        labels = _labels(game=game or "", span=name)
+        lines.append("votechess_span_seconds_sum{} {}".format(labels, total))
+        lines.append("votechess_span_seconds_count{} {}".format(labels, n))
+    names = []
+    for ((name, _), _) in counters:
+        if name not in names:
+            names.append(name)
+    for name in names:
+        lines.append("# TYPE votechess_{}_total counter".format(name))
+        for ((cname, labels), value) in counters:
+            if cname == name:
+                lines.append("votechess_{}_total{} {}".format(
+                    name, _labels(**dict(labels)), value))
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    # Atomically, so a node exporter's textfile collector never reads half
+    tmp = path + ".tmp"
+    with open(tmp, "w") as promfile:
+        promfile.write(prometheus_text())
+    os.replace(tmp, path)
@@ -0,0 +1,150 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import io
+import threading
+
+from postqueue import PostQueue
+
+
+class Mirrors:
+    """Copies of a game's posts and polls on other instances.
+
+    Every upload and status sent to the primary server is repeated on each
+    mirror, on that mirror's own post queue: mirrors post concurrently with
+    the primary and each other, and a slow or unreachable instance delays
+    only its own copies. Replies and attachments are mapped to the mirror's
+    ids as the primary ids come back. ``ids`` (primary status id to
+    ``{server: id}``, for the last ``keep`` statuses) is handed to
+    ``on_ids`` whenever it changes, so the game can persist it. ``clients``
+    pairs each server with a function returning its client, called on the
+    first post or fetch there.
+    """
+
+    def __init__(self, clients, timeout=20, min_interval=0.0, ids=None,
+                 on_ids=None, keep=8):
+        self.servers = [server for (server, _) in clients]
+        self._factories = dict(clients)
+        self._clients = dict()
+        self.timeout = timeout
+        self.keep = keep
+        self.on_ids = on_ids
+        self.ids = dict(ids or {})
+        self._media = dict()
+        # Mirror status posts not yet known to have finished
+        self._statuses = []
+        self._lock = threading.Lock()
+        self._queues = {server: PostQueue(min_interval) for server in self.servers}
+        self._fetches = ThreadPoolExecutor(max_workers=max(1, len(clients)),
+                                           thread_name_prefix="mirrors")
+
+    def __len__(self):
+        return len(self.servers)
+
+    def _client(self, server):
+        with self._lock:
+            client = self._clients.get(server)
+            if client is None:
+                client = self._factories[server]()
+                self._clients[server] = client
+        return client
+
+    def _mirror_id(self, server, primary_id):
+        with self._lock:
+            return self.ids.get(str(primary_id), {}).get(server)
+
+    def _record(self, server, primary_id, mirror_id):
+        with self._lock:
+            ids = dict(self.ids)
+            ids[str(primary_id)] = dict(ids.pop(str(primary_id), {}))
+            ids[str(primary_id)][server] = mirror_id
+            while len(ids) > self.keep:
+                del ids[next(iter(ids))]
+            self.ids = ids
+        if self.on_ids is not None:
+            self.on_ids(ids)
+
+    def media_post(self, uploaded, data, args, kwargs):
+        # Upload `data` everywhere; `uploaded` resolves to the primary's id
+        for server in self.servers:
+            self._queues[server].submit(self._media_post, server, uploaded,
+                                        data, args, kwargs)
+
+    def _media_post(self, server, uploaded, data, args, kwargs):
+        try:
+            media = self._client(server).media_post(io.BytesIO(data), *args, **kwargs)
+            with self._lock:
+                self._media[(server, str(uploaded.result()))] = media["id"]
+        except Exception as e:
+            print("Failed to upload to {}".format(server))
+            print(e)
+
+    def status_post(self, posted, args, kwargs):
+        # Post everywhere; `posted` resolves to the primary's status id
+        for server in self.servers:
+            job = self._queues[server].submit(self._status_post, server, posted,
+                                              args, kwargs)
+            with self._lock:
+                self._statuses.append(job)
+
+    def settle(self):
+        # Wait, up to `timeout` seconds in all, for the statuses posted so
+        # far to reach every mirror, so that their ids are recorded before
+        # the game state is saved
+        with self._lock:
+            self._statuses = [job for job in self._statuses if not job.done()]
+            pending = list(self._statuses)
+        (_, late) = wait(pending, timeout=self.timeout)
+        if len(late) > 0:
+            print("{} mirror posts still pending; polls on those mirrors "
+                  "will not be counted".format(len(late)))
+
+    def _status_post(self, server, posted, args, kwargs):
+        kwargs = dict(kwargs)
+        if kwargs.get("in_reply_to_id") is not None:
+            # Top-level on this mirror if its copy of the parent never posted
+            kwargs["in_reply_to_id"] = self._mirror_id(server,
+                                                       kwargs["in_reply_to_id"])
+        if kwargs.get("media_ids") is not None:
+            media = kwargs["media_ids"]
+            media = media if isinstance(media, (list, tuple)) else [media]
+            with self._lock:
+                media = [self._media.get((server, str(m["id"] if isinstance(m, dict) else m)))
+                         for m in media]
+            kwargs["media_ids"] = [m for m in media if m is not None] or None
+        try:
+            status = self._client(server).status_post(*args, **kwargs)
+            self._record(server, posted.result(), status["id"])
+        except Exception as e:
+            print("Failed to post to {}".format(server))
+            print(e)
+
+    def votes(self, postid):
+        # {option title: votes} summed over the mirrors' copies of the poll
+        # on primary status `postid`. Mirrors that fail, or do not answer
+        # within `timeout` seconds, count as no votes.
+        fetches = dict()
+        for server in self.servers:
+            mirror_id = self._mirror_id(server, postid)
+            if mirror_id is not None:
+                fetches[server] = self._fetches.submit(
+                    lambda s=server, i=mirror_id: self._client(s).status(id=i))
+        (done, _) = wait(fetches.values(), timeout=self.timeout)
+        totals = dict()
+        for (server, fetch) in fetches.items():
+            if fetch not in done:
+                print("No poll results from {} in time; counting no votes".format(server))
+                continue
+            try:
+                poll = fetch.result()["poll"]
+            except Exception as e:
+                print("Failed to get poll results from {}".format(server))
+                print(e)
+                continue
+            for option in (poll or {}).get("options", []):
+                totals[option["title"]] = (totals.get(option["title"], 0)
+                                           + (option["votes_count"] or 0))
+        return totals
+
+    def close(self):
+        for queue in self._queues.values():
+            queue.close()
+        self._fetches.shutdown(wait=False)
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+import threading
+
+import chess.polyglot
+
+
+class OpeningBook:
+    """A polyglot book memory-mapped once per process.
+
+    The file is never read into RAM: lookups binary-search the mapping and
+    the legal entries for each position are kept in a bounded LRU index keyed
+    by Zobrist hash, as tuples of moves, weights and learn values. numpy is
+    only imported when a position has more book moves than are asked for.
+    """
+
+    def __init__(self, path, max_positions=4096):
+        self.path = path
+        self.max_positions = max_positions
+        self._reader = chess.polyglot.MemoryMappedReader(path)
+        self._index = OrderedDict()
+        self._lock = threading.Lock()
+
+    def entries(self, board):
+        key = chess.polyglot.zobrist_hash(board)
+        with self._lock:
+            found = self._index.get(key)
+            if found is not None:
+                self._index.move_to_end(key)
+                return found
+            found = tuple(self._reader.find_all(board))
+            found = (tuple(e.move for e in found),
+                     tuple(e.weight for e in found),
+                     tuple(e.learn for e in found))
+            self._index[key] = found
+            if len(self._index) > self.max_positions:
+                self._index.popitem(last=False)
+        return found
+
+    def sample(self, board, k=1):
+        # Weighted sample of k distinct book moves, or all of them if the
+        # book has no more than k for this position
+        (moves, weights, _) = self.entries(board)
+        if len(moves) <= k:
+            return list(moves)
+        from numpy import array, float64
+        from numpy.random import choice
+        weights = array(weights, dtype=float64)
+        chosen = choice(len(moves), k, replace=False, p=weights / weights.sum())
+        return [moves[i] for i in chosen]
+
+    def close(self):
+        self._reader.close()
+
+
+_books = dict()
+
+
+def open_book(path):
+    # Books are shared by every game in the process that names the same file
+    path = str(path)
+    book = _books.get(path)
+    if book is None:
+        book = OpeningBook(path)
+        _books[path] = book
+    return book
+
+
+def close_books():
+    for book in _books.values():
+        book.close()
+    _books.clear()
@@ -0,0 +1,117 @@
+import asyncio
+import datetime
+
+from mastodon import StreamListener
+
+# Re-fetches of a poll the server has not yet marked expired: the first
+# after this many seconds, doubling until the next would pass the cap
+EXPIRY_RETRY = 1
+EXPIRY_RETRY_MAX = 16
+
+
+class PollWatcher(StreamListener):
+    """Waits for a posted poll to close, or to be decided early.
+
+    Listens on the user stream for the "poll" notification Mastodon sends
+    when the poll ends; if the stream cannot be opened, waits out the
+    expiry time instead. Either way, at expiry the poll is fetched again
+    (backing off from EXPIRY_RETRY seconds, up to EXPIRY_RETRY_MAX) until
+    the server reports it expired. With a ``lead`` (votes between the first
+    and second options) or ``votes`` (total) threshold, the poll is also
+    fetched every ``check_interval`` seconds, doubling up to
+    ``max_interval``, and counts as decided once either is reached. Nothing
+    is fetched in between.
+    """
+
+    def __init__(self, mastodon, status_id, expires_at, lead=None, votes=None,
+                 check_interval=60, max_interval=900, stream=True):
+        self.mastodon = mastodon
+        self.status_id = status_id
+        self.expires_at = expires_at
+        self.lead = lead
+        self.votes = votes
+        self.check_interval = check_interval
+        self.max_interval = max_interval
+        self.stream = stream
+        self._loop = None
+        self._closed = None
+
+    def on_notification(self, notification):
+        # Runs on the stream's thread
+        status = notification.get("status") or {}
+        if notification.get("type") == "poll" and str(status.get("id")) == str(self.status_id):
+            self._loop.call_soon_threadsafe(self._closed.set)
+
+    def decided(self, poll):
+        counts = sorted((option["votes_count"] or 0 for option in poll["options"]),
+                        reverse=True)
+        if self.votes is not None and sum(counts) >= self.votes:
+            return True
+        if self.lead is not None and len(counts) > 1 and counts[0] - counts[1] >= self.lead:
+            return True
+        return False
+
+    async def _sleep(self, stop, timeout):
+        # Until the timeout, a stop request or the poll's notification
+        waits = [asyncio.ensure_future(stop.wait()),
+                 asyncio.ensure_future(self._closed.wait())]
+        try:
+            await asyncio.wait(waits, timeout=max(0, timeout),
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for w in waits:
+                w.cancel()
+
+    def _remaining(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return (self.expires_at - now).total_seconds()
+
+    async def wait(self, stop):
+        # "stopped", "closed" (notified), "expired" or "decided"
+        self._loop = asyncio.get_running_loop()
+        self._closed = asyncio.Event()
+        handle = None
+        if self.stream:
+            try:
+                handle = await self._loop.run_in_executor(
+                    None, lambda: self.mastodon.stream_user(
+                        self, run_async=True, reconnect_async=True))
+            except Exception as e:
+                print("Failed to open the user stream; waiting for the expiry time")
+                print(e)
+        try:
+            interval = self.check_interval
+            retry = EXPIRY_RETRY
+            early = self.lead is not None or self.votes is not None
+            while True:
+                remaining = self._remaining()
+                if remaining > 0:
+                    await self._sleep(stop, min(remaining, interval) if early
+                                      else remaining)
+                    if stop.is_set():
+                        return "stopped"
+                    if self._closed.is_set():
+                        return "closed"
+                    if not early and self._remaining() > 0:
+                        continue
+                poll = (await self._loop.run_in_executor(
+                    None, lambda: self.mastodon.status(id=self.status_id)))["poll"]
+                if poll is None or poll.get("expired"):
+                    return "expired"
+                if self._remaining() <= 0:
+                    # Expired by our clock but not yet by the server's
+                    await self._sleep(stop, retry)
+                    if stop.is_set():
+                        return "stopped"
+                    if self._closed.is_set():
+                        return "closed"
+                    retry = 2 * retry
+                    if retry > EXPIRY_RETRY_MAX:
+                        return "expired"
+                    continue
+                if self.decided(poll):
+                    return "decided"
+                interval = min(2 * interval, self.max_interval)
+        finally:
+            if handle is not None:
+                handle.close()
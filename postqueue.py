@@ -0,0 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+from metrics import propagate
+
+
+class PostQueue:
+    """Runs Mastodon calls in order on one background thread.
+
+    Jobs run strictly in submission order, so a reply is never posted before
+    the status it answers, while the caller carries on with other work.
+    Rate limits are left to the client's ``ratelimit_method="wait"``; an
+    optional minimum gap between jobs spaces out bursts further.
+    """
+
+    def __init__(self, min_interval=0.0):
+        self.min_interval = min_interval
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="posts")
+        self._last = 0.0
+
+    def _run(self, fn, args, kwargs):
+        wait = self._last + self.min_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._last = time.monotonic()
+
+    def submit(self, fn, *args, **kwargs):
+        # Returns a Future for fn's result
+        return self._executor.submit(propagate(self._run), fn, args, kwargs)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,225 @@
+from collections import OrderedDict
+import io
+import math
+import os
+import threading
+
+import chess
+import chess.svg
+from PIL import Image, ImageColor, ImageDraw
+
+# Board geometry in chess.svg units; every sprite is scaled from these
+SQUARE_SIZE = chess.svg.SQUARE_SIZE
+MARGIN = 15
+COORD_SCALE = MARGIN / chess.svg.MARGIN
+# Arrows are drawn at this multiple of the output size and downsampled, as
+# Pillow does not antialias polygons
+ARROW_SUPERSAMPLE = 2
+
+
+def _rgba(colour, opacity=1.0):
+    (r, g, b, a) = ImageColor.getcolor(colour, "RGBA")
+    return (r, g, b, int(round(a * opacity)))
+
+
+def _select_rgba(colours, name):
+    return _rgba(colours.get(name, chess.svg.DEFAULT_COLORS[name]))
+
+
+def _rasterize(svg, width, height):
+    # Only needed the first time a sprite is built at a given scale
+    from cairosvg import svg2png
+    png = svg2png(bytestring=svg, output_width=width, output_height=height)
+    return Image.open(io.BytesIO(png)).convert("RGBA")
+
+
+def _coord_svg(text, horizontal):
+    (w, h) = (SQUARE_SIZE, MARGIN) if horizontal else (MARGIN, SQUARE_SIZE)
+    offset = int(SQUARE_SIZE - COORD_SCALE * SQUARE_SIZE) // 2
+    (x, y) = (offset, 0) if horizontal else (0, offset)
+    return ('<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {} {}">'
+            '<g transform="translate({}, {}) scale({}, {})" fill="#fff" '
+            'stroke="#fff">{}</g></svg>').format(
+                w, h, x, y, COORD_SCALE, COORD_SCALE, chess.svg.COORDS[text])
+
+
+class SpriteRenderer:
+    """Board renderer that composites pre-rasterized sprites with Pillow.
+
+    Piece and coordinate sprites are rasterized once per scale, through
+    cairosvg, and kept in ``sprite_dir`` so later runs never touch the SVG
+    pipeline. Squares, highlights and arrows are drawn directly from the
+    ``board_colours`` palette. Finished PNGs are kept in a small LRU keyed by
+    position, orientation, last move and arrows.
+    """
+
+    def __init__(self, scale, colours=None, sprite_dir=None, cache_size=32):
+        self.scale = scale
+        self.colours = colours or {}
+        self.sprite_dir = sprite_dir
+        self.cache_size = cache_size
+        self.square = int(round(SQUARE_SIZE * scale))
+        self.margin = int(round(MARGIN * scale))
+        self.size = 8 * self.square + 2 * self.margin
+        self._sprites = dict()
+        self._bases = dict()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _sprite(self, name, svg, width, height):
+        sprite = self._sprites.get(name)
+        if sprite is not None:
+            return sprite
+        path = None
+        if self.sprite_dir is not None:
+            path = os.path.join(self.sprite_dir, str(self.scale),
+                                "{}.png".format(name))
+            if os.path.exists(path):
+                sprite = Image.open(path).convert("RGBA")
+        if sprite is None:
+            sprite = _rasterize(svg, width, height)
+            if path is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                sprite.save(path)
+        self._sprites[name] = sprite
+        return sprite
+
+    def _piece(self, piece):
+        symbol = piece.symbol()
+        name = ("w" if piece.color == chess.WHITE else "b") + symbol.upper()
+        return self._sprite(name, str(chess.svg.piece(piece)), self.square,
+                            self.square)
+
+    def _coord(self, text, horizontal):
+        (w, h) = ((self.square, self.margin) if horizontal
+                  else (self.margin, self.square))
+        glyph = self._sprite("coord-{}".format(text),
+                             _coord_svg(text, horizontal), w, h)
+        # Tint the white glyph with the palette colour, keeping its alpha
+        colour = _select_rgba(self.colours, "coord")
+        tinted = Image.new("RGBA", glyph.size, colour[:3] + (0,))
+        alpha = glyph.getchannel("A").point(lambda a: a * colour[3] // 255)
+        tinted.putalpha(alpha)
+        return tinted
+
+    def _origin(self, square, flipped):
+        file_index = chess.square_file(square)
+        rank_index = chess.square_rank(square)
+        x = (7 - file_index if flipped else file_index) * self.square
+        y = (rank_index if flipped else 7 - rank_index) * self.square
+        return (x + self.margin, y + self.margin)
+
+    def _square_rgba(self, square, lastmove=False):
+        light = chess.BB_LIGHT_SQUARES & chess.BB_SQUARES[square]
+        name = ["square", "light" if light else "dark"]
+        if lastmove:
+            name.append("lastmove")
+        return _select_rgba(self.colours, " ".join(name))
+
+    def _base(self, flipped):
+        # Margin, coordinates and empty squares for one orientation
+        base = self._bases.get(flipped)
+        if base is not None:
+            return base
+        base = Image.new("RGBA", (self.size, self.size),
+                         _select_rgba(self.colours, "margin"))
+        draw = ImageDraw.Draw(base)
+        for square in chess.SQUARES:
+            (x, y) = self._origin(square, flipped)
+            draw.rectangle((x, y, x + self.square - 1, y + self.square - 1),
+                           fill=self._square_rgba(square))
+        far = self.margin + 8 * self.square
+        for file_index, file_name in enumerate(chess.FILE_NAMES):
+            x = (7 - file_index if flipped else file_index) * self.square + self.margin
+            glyph = self._coord(file_name, True)
+            base.alpha_composite(glyph, (x, 0))
+            base.alpha_composite(glyph, (x, far))
+        for rank_index, rank_name in enumerate(chess.RANK_NAMES):
+            y = (rank_index if flipped else 7 - rank_index) * self.square + self.margin
+            glyph = self._coord(rank_name, False)
+            base.alpha_composite(glyph, (0, y))
+            base.alpha_composite(glyph, (far, y))
+        self._bases[flipped] = base
+        return base
+
+    def _arrows(self, arrows, flipped):
+        ss = ARROW_SUPERSAMPLE
+        layer = Image.new("RGBA", (self.size * ss, self.size * ss), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(layer)
+        sq = self.square * ss
+        colour = _select_rgba(self.colours, "arrow green")
+        for (tail, head) in arrows:
+            (xtail, ytail) = self._origin(tail, flipped)
+            (xhead, yhead) = self._origin(head, flipped)
+            (xtail, ytail) = (xtail * ss + sq / 2, ytail * ss + sq / 2)
+            (xhead, yhead) = (xhead * ss + sq / 2, yhead * ss + sq / 2)
+            if tail == head:
+                r = sq * 0.9 / 2
+                draw.ellipse((xhead - r, yhead - r, xhead + r, yhead + r),
+                             outline=colour, width=int(round(sq * 0.1)))
+                continue
+            marker_size = 0.75 * sq
+            marker_margin = 0.1 * sq
+            (dx, dy) = (xhead - xtail, yhead - ytail)
+            hypot = math.hypot(dx, dy)
+            shaft_x = xhead - dx * (marker_size + marker_margin) / hypot
+            shaft_y = yhead - dy * (marker_size + marker_margin) / hypot
+            xtip = xhead - dx * marker_margin / hypot
+            ytip = yhead - dy * marker_margin / hypot
+            # Butt-capped shaft, 0.2 squares wide
+            (nx, ny) = (-dy * 0.1 * sq / hypot, dx * 0.1 * sq / hypot)
+            draw.polygon([(xtail + nx, ytail + ny), (shaft_x + nx, shaft_y + ny),
+                          (shaft_x - nx, shaft_y - ny), (xtail - nx, ytail - ny)],
+                         fill=colour)
+            draw.polygon([(xtip, ytip),
+                          (shaft_x + dy * 0.5 * marker_size / hypot,
+                           shaft_y - dx * 0.5 * marker_size / hypot),
+                          (shaft_x - dy * 0.5 * marker_size / hypot,
+                           shaft_y + dx * 0.5 * marker_size / hypot)],
+                         fill=colour)
+        return layer.resize((self.size, self.size), Image.LANCZOS)
+
+    def render(self, board, flipped=False, lastmove=None, arrows=()):
+        with self._lock:
+            return self._render(board, flipped, lastmove, arrows)
+
+    def _render(self, board, flipped, lastmove, arrows):
+        arrows = tuple((tail, head) for (tail, head) in arrows)
+        key = (board.board_fen(), flipped,
+               None if lastmove is None else lastmove.uci(), arrows)
+        png = self._cache.get(key)
+        if png is not None:
+            self._cache.move_to_end(key)
+            return png
+        image = self._base(flipped).copy()
+        if lastmove is not None:
+            draw = ImageDraw.Draw(image)
+            for square in (lastmove.from_square, lastmove.to_square):
+                (x, y) = self._origin(square, flipped)
+                draw.rectangle((x, y, x + self.square - 1, y + self.square - 1),
+                               fill=self._square_rgba(square, True))
+        for (square, piece) in board.piece_map().items():
+            image.alpha_composite(self._piece(piece),
+                                  self._origin(square, flipped))
+        if len(arrows) > 0:
+            image.alpha_composite(self._arrows(arrows, flipped))
+        out = io.BytesIO()
+        image.save(out, format="PNG")
+        png = out.getvalue()
+        self._cache[key] = png
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return png
+
+
+_renderers = dict()
+
+
+def sprite_renderer(scale, colours=None, sprite_dir=None):
+    # One renderer per scale and palette, shared by every game in the process
+    key = (scale, tuple(sorted((colours or {}).items())), sprite_dir)
+    renderer = _renderers.get(key)
+    if renderer is None:
+        renderer = SpriteRenderer(scale, colours, sprite_dir)
+        _renderers[key] = renderer
+    return renderer
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# Offline simulation: plays whole games through VoteChessGame's turn logic,
+# with votes drawn from a model rather than Mastodon polls, to evaluate a
+# configuration over many games. Nothing is posted or rendered and no
+# files but a scratch game state are written.
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import contextlib
+import copy
+import datetime
+import io
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import time
+
+import chess
+import chess.engine
+import chess.pgn
+import chess.polyglot
+import numpy
+
+import votechess
+from engines import shared_session, close_sessions
+from openingbook import close_books
+from tablebase import close_tablebases
+from gamestate import GameStore
+
+parser = argparse.ArgumentParser(
+    description="Simulate vote chess games offline. Options not listed here "
+    "(e.g. --human-depth, --engine-depth, --claim50, --per-move-rating) are "
+    "passed on to votechess.py's own parser.")
+parser.add_argument(help="Config file (json) to simulate", dest="config_file")
+parser.add_argument("-n", "--games", type=int, default=100, dest="games",
+                    help="Games to play (default: 100)")
+parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                    dest="workers", help="Worker processes (default: one per core)")
+parser.add_argument("--votes", default="uniform", dest="votes",
+                    choices=["uniform", "engine", "archive"],
+                    help="Vote model (default: uniform)")
+parser.add_argument("--voters", type=int, default=20, dest="voters",
+                    help="Votes cast in each poll (default: 20)")
+parser.add_argument("--vote-depth", type=int, default=4, dest="vote_depth",
+                    help="engine model: search depth for weighting the options")
+parser.add_argument("--temperature", type=float, default=100.0,
+                    dest="temperature", help="engine model: centipawns per "
+                    "factor of e between option weights (default: 100)")
+parser.add_argument("--archive", dest="archive",
+                    help="archive model: PGN archive to replay human moves from "
+                    "(default: the config's archive_file)")
+parser.add_argument("--max-plies", type=int, default=400, dest="max_plies",
+                    help="Abandon games longer than this (default: 400)")
+parser.add_argument("--seed", type=int, default=0, dest="seed")
+parser.add_argument("-o", "--output", dest="output",
+                    help="Write per-game results and totals here (json)")
+
+
+class UniformVotes:
+    # Every option equally likely for each voter
+
+    def __init__(self, opts, config):
+        self.voters = opts.voters
+
+    def votes(self, board, options, rng):
+        return list(rng.multinomial(self.voters, [1 / len(options)] * len(options)))
+
+
+class EngineVotes(UniformVotes):
+    # Voters favour the options a shallow search rates best, with weights
+    # falling by a factor of e per `temperature` centipawns. "Resign" gets the
+    # weight of the worst move.
+
+    def __init__(self, opts, config):
+        super().__init__(opts, config)
+        self.temperature = opts.temperature
+        self.limit = chess.engine.Limit(depth=opts.vote_depth)
+        self.engines = shared_session(config["engine"])
+
+    def votes(self, board, options, rng):
+        moves = [mv for mv in options if bool(mv)]
+        rated = votechess.eng_rate(moves, board, self.engines, self.limit)
+        # Scores are for the side to move after each option: lower is better
+        scores = {mv: sc.score(mate_score=votechess.MATE_SCORE)
+                  for (mv, sc, _) in rated}
+        worst = max(scores.values())
+        best = min(scores.values())
+        weights = [math.exp(-((scores[mv] if bool(mv) else worst) - best)
+                            / self.temperature) for mv in options]
+        total = sum(weights)
+        return list(rng.multinomial(self.voters, [w / total for w in weights]))
+
+
+class ArchiveVotes(UniformVotes):
+    # Replays the moves the humans chose in archived games: each voter picks
+    # among the options in proportion to how often the humans played them
+    # from this position, or uniformly if they never reached it
+
+    def __init__(self, opts, config):
+        super().__init__(opts, config)
+        self.played = dict()
+        # Streamed straight from the PGN, so no archive index is written
+        with open(opts.archive or config["archive_file"], "r") as pgnfile:
+            game = chess.pgn.read_game(pgnfile)
+            while game is not None:
+                self.add(game)
+                game = chess.pgn.read_game(pgnfile)
+
+    def add(self, game):
+        human = (chess.BLACK if "(depth" in game.headers.get("White", "")
+                 else chess.WHITE)
+        board = game.board()
+        for mv in game.mainline_moves():
+            if board.turn == human:
+                counts = self.played.setdefault(
+                    chess.polyglot.zobrist_hash(board), dict())
+                counts[mv] = counts.get(mv, 0) + 1
+            board.push(mv)
+
+    def votes(self, board, options, rng):
+        counts = self.played.get(chess.polyglot.zobrist_hash(board), {})
+        weights = [counts.get(mv, 0) for mv in options]
+        if sum(weights) == 0:
+            return super().votes(board, options, rng)
+        total = sum(weights)
+        return list(rng.multinomial(self.voters, [w / total for w in weights]))
+
+
+VOTE_MODELS = {"uniform": UniformVotes, "engine": EngineVotes,
+               "archive": ArchiveVotes}
+
+# (white, black) points for each game result
+POINTS = {"1-0": (1.0, 0.0), "0-1": (0.0, 1.0), "1/2-1/2": (0.5, 0.5)}
+
+
+class SimulatedServer:
+    # Stands in for the Mastodon client. Polls are kept in memory and their
+    # votes are drawn from the model when fetched.
+
+    def __init__(self, model, rng):
+        self.model = model
+        self.rng = rng
+        self.board = None
+        self.polls = dict()
+        self._ids = itertools.count(1)
+
+    def media_post(self, *args, **kwargs):
+        return {"id": "0"}
+
+    def make_poll(self, options, expires_in=None):
+        return {"options": options, "expires_in": expires_in}
+
+    def status_post(self, text, poll=None, **kwargs):
+        status = {"id": str(next(self._ids)), "poll": None}
+        if poll is not None:
+            self.polls[status["id"]] = poll["options"]
+            status["poll"] = {
+                "expires_at": datetime.datetime.now(datetime.timezone.utc),
+                "options": [{"title": t, "votes_count": 0}
+                            for t in poll["options"]]}
+        return status
+
+    def status(self, id):
+        titles = self.polls.get(id)
+        if titles is None:
+            return {"id": id, "poll": None}
+        options = [(self.board.parse_san(t) if t != "Resign"
+                    else chess.Move.null()) for t in titles]
+        votes = self.model.votes(self.board, options, self.rng)
+        return {"id": id, "poll": {"options": [
+            {"title": t, "votes_count": int(v)} for (t, v) in zip(titles, votes)]}}
+
+
+class SimulatedGame(votechess.VoteChessGame):
+    # A VoteChessGame whose config lives in memory, whose polls are answered
+    # by a vote model, and which never renders, posts or archives
+
+    def __init__(self, config, args, model, rng, workdir):
+        self.base_config = config
+        self.workdir = workdir
+        self.result = None
+        super().__init__(os.path.join(workdir, "simulation.json"), args)
+        self.mastodon = SimulatedServer(model, rng)
+
+    def load_config(self):
+        self.state = GameStore(os.path.join(self.workdir, "simulation.state"))
+        self.state.clear()
+        config = copy.deepcopy(self.base_config)
+        # Whatever the config says, no mirror is ever posted to
+        config.pop("mirrors", None)
+        return config
+
+    def save_config(self):
+        pass
+
+    def print_board(self, board, choices=None):
+        return b""
+
+    def archive_game(self, pgn):
+        self.result = pgn.headers["Result"]
+
+    def get_vote_results(self, curBoard):
+        self.mastodon.board = curBoard
+        return super().get_vote_results(curBoard)
+
+
+def play_games(config, argv, opts, indices):
+    # Worker: play the games numbered `indices`, one after another
+    results = []
+    args = votechess.parser.parse_args([config["name"]] + argv)
+    args.no_check_api = True
+    try:
+        with tempfile.TemporaryDirectory(prefix="votechess-sim-") as workdir, \
+                contextlib.redirect_stdout(io.StringIO()) as out:
+            model = VOTE_MODELS[opts.votes](opts, config)
+            for i in indices:
+                out.seek(0)
+                out.truncate()
+                results.append(play_game(config, args, opts, model, i, workdir))
+    finally:
+        close_sessions()
+        close_books()
+        close_tablebases()
+    return results
+
+
+def play_game(config, args, opts, model, i, workdir):
+    random.seed(opts.seed + i)
+    numpy.random.seed(opts.seed + i)
+    config = copy.deepcopy(config)
+    # Alternate colours, as the bot does between rounds
+    if i % 2 == 1:
+        config["human"]["colour"] = ("WHITE" if config["human"].get("colour") == "BLACK"
+                                     else "BLACK")
+    game = SimulatedGame(config, args, model,
+                         numpy.random.default_rng(opts.seed + i), workdir)
+    start = time.perf_counter()
+    turns = 0
+    try:
+        while game.result is None and not game.stopped and 2 * turns < opts.max_plies:
+            game.run_turn()
+            turns += 1
+    finally:
+        game.close()
+    colour = config["human"].get("colour", "WHITE")
+    # Scored from the archived result, not the config's running totals
+    (white, black) = POINTS.get(game.result, (0.0, 0.0))
+    (human, engine) = (white, black) if colour == "WHITE" else (black, white)
+    return {"game": i, "colour": colour, "result": game.result, "turns": turns,
+            "human_score": human, "engine_score": engine,
+            "seconds": time.perf_counter() - start}
+
+
+def main():
+    (opts, argv) = parser.parse_known_args()
+    with open(opts.config_file, "r") as configfile:
+        config = json.load(configfile)
+    config.setdefault("name", opts.config_file)
+    config["human"]["score"] = 0.0
+    config["engine"]["score"] = 0.0
+    # Offline: no lichess fallback, and no shared cache file between workers
+    config["tablebase_online"] = False
+    config.pop("analysis_cache", None)
+    config.pop("speculate", None)
+    config.pop("mirrors", None)
+    overrides = votechess.parser.parse_args([opts.config_file] + argv)
+    if overrides.hdist is not None:
+        config["human"]["depth"] = overrides.hdist
+    if overrides.edist is not None:
+        config["engine"]["depth"] = overrides.edist
+    if overrides.polyglot_book is not None:
+        config["polyglot_book"] = overrides.polyglot_book
+    workers = max(1, min(opts.workers, opts.games))
+    # Searches within a game stay on one engine process per worker
+    config["engine"]["pool_size"] = 1
+    chunks = [list(range(opts.games))[w::workers] for w in range(workers)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = [r for chunk in executor.map(
+            play_games, itertools.repeat(config), itertools.repeat(argv),
+            itertools.repeat(opts), chunks) for r in chunk]
+    elapsed = time.perf_counter() - start
+    results.sort(key=lambda r: r["game"])
+    finished = [r for r in results if r["result"] is not None]
+    totals = {
+        "games": len(results),
+        "finished": len(finished),
+        "seconds": elapsed,
+        "games_per_second": len(results) / elapsed,
+        "human_score": sum(r["human_score"] for r in finished),
+        "engine_score": sum(r["engine_score"] for r in finished),
+        "human_wins": sum(1 for r in finished if r["human_score"] == 1.0),
+        "draws": sum(1 for r in finished if r["human_score"] == 0.5),
+        "engine_wins": sum(1 for r in finished if r["engine_score"] == 1.0),
+        "mean_turns": (sum(r["turns"] for r in finished) / len(finished)
+                       if len(finished) > 0 else None),
+    }
+    print("{games} games ({finished} finished) in {seconds:.1f}s: "
+          "{games_per_second:.2f} games/s".format(**totals))
+    print("Humans {human_score} - {engine_score} engine "
+          "(+{human_wins} ={draws} -{engine_wins})".format(**totals))
+    if opts.output is not None:
+        with open(opts.output, "w") as outfile:
+            json.dump({"settings": vars(opts), "argv": argv, "totals": totals,
+                       "results": results}, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import chess.polyglot
+
+from engines import StopSignal, Stopped
+
+
+class Speculator:
+    """Runs analysis for the open poll on a background thread.
+
+    Jobs are ``(option, fn)`` pairs run in order until the budget runs out
+    or :meth:`stop` is called. ``fn()`` returns ``(kind, board, value)``
+    records, each stored for that poll option under ``(kind,
+    zobrist_hash(board))``. Once the vote is known, :meth:`settle` throws
+    away everything computed for the options that lost. Jobs for no
+    particular option (``option=None``) survive until the next
+    :meth:`start`. Engine searches made by the jobs through
+    ``engines.stoppable_analyse`` are cut short by :meth:`stop`.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="speculation")
+        self._stop = StopSignal()
+        self._lock = threading.Lock()
+        self._future = None
+        self._results = dict()
+        self.hits = 0
+        self.done = 0
+
+    def _run(self, jobs, deadline):
+        with self._stop.applied():
+            self._run_jobs(jobs, deadline)
+
+    def _run_jobs(self, jobs, deadline):
+        for (option, fn) in jobs:
+            if self._stop.is_set() or time.monotonic() >= deadline:
+                break
+            try:
+                records = fn()
+            except Stopped:
+                break
+            except Exception as e:
+                print("Speculative analysis failed")
+                print(e)
+                continue
+            with self._lock:
+                results = self._results.setdefault(option, dict())
+                for (kind, board, value) in records:
+                    results[(kind, chess.polyglot.zobrist_hash(board))] = value
+                    self.done += 1
+
+    def start(self, jobs, budget):
+        # Replaces any earlier speculation
+        self.stop()
+        with self._lock:
+            self._results.clear()
+            (self.hits, self.done) = (0, 0)
+        self._stop.clear()
+        self._future = self._executor.submit(
+            self._run, list(jobs), time.monotonic() + budget)
+
+    def stop(self):
+        # Stops the search in progress, if any, and waits for its job to
+        # give up
+        self._stop.set()
+        if self._future is not None:
+            self._future.result()
+            self._future = None
+
+    def get(self, kind, board):
+        key = (kind, chess.polyglot.zobrist_hash(board))
+        with self._lock:
+            for results in self._results.values():
+                if key in results:
+                    self.hits += 1
+                    return results[key]
+        return None
+
+    def settle(self, option):
+        # Keep only what was computed for the winning option
+        with self._lock:
+            for other in list(self._results):
+                if other is not None and other != option:
+                    del self._results[other]
+
+    def close(self):
+        self.stop()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,114 @@
+from collections import OrderedDict
+import threading
+
+import chess
+import chess.engine
+import chess.polyglot
+
+from metrics import hook_session
+
+LICHESS_API = "http://tablebase.lichess.ovh/standard"
+# lichess.ovh categories, as WDL from the side to move
+CATEGORIES = {"win": 2, "cursed-win": 1, "draw": 0, "blessed-loss": -1,
+              "loss": -2}
+# Centipawn scores for tablebase results in candidate ratings: clear of any
+# engine evaluation, but below a forced mate the engine has actually found
+TB_WIN = 20000
+
+
+class Tablebase:
+    """WDL probes for adjudication and rating, with an LRU of results.
+
+    Probes local Syzygy files through chess.syzygy when ``syzygy_path`` is
+    set. The lichess.ovh API is an optional fallback for positions the local
+    tables do not cover, over one pooled HTTP session.
+    """
+
+    def __init__(self, syzygy_path=None, online=True, timeout=10,
+                 cache_size=65536):
+        self.online = online
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self._tables = None
+        if syzygy_path is not None:
+            import chess.syzygy
+            self._tables = chess.syzygy.open_tablebase(syzygy_path)
+        self._session = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, wdl):
+        with self._lock:
+            self._cache[key] = wdl
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _probe_online(self, board):
+        if self._session is None:
+            import requests
+            self._session = hook_session(requests.Session())
+        r = self._session.get(LICHESS_API,
+                              params={"fen": board.fen().replace(" ", "_")},
+                              timeout=self.timeout)
+        r.raise_for_status()
+        res = r.json()
+        if res.get("wdl") is not None:
+            return res.get("wdl")
+        return CATEGORIES.get(res.get("category"))
+
+    def probe_wdl(self, board, online=None):
+        # WDL for the side to move, or None if nothing could tell. Local
+        # probes are cheap; online=False skips the HTTP fallback.
+        key = chess.polyglot.zobrist_hash(board)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        wdl = None
+        if self._tables is not None:
+            wdl = self._tables.get_wdl(board)
+        if wdl is None and (self.online if online is None else online):
+            wdl = self._probe_online(board)
+        if wdl is not None:
+            self._remember(key, wdl)
+        return wdl
+
+    def score(self, board):
+        # Candidate rating shortcut: a tablebase position's score relative to
+        # the side to move, from local tables only
+        if self._tables is None or len(board.piece_map()) > 7:
+            return None
+        wdl = self.probe_wdl(board, online=False)
+        if wdl is None:
+            return None
+        if wdl == 2:
+            return chess.engine.Cp(TB_WIN)
+        if wdl == -2:
+            return chess.engine.Cp(-TB_WIN)
+        # Cursed wins and blessed losses are draws under the 50-move rule
+        return chess.engine.Cp(0)
+
+    def close(self):
+        if self._tables is not None:
+            self._tables.close()
+        if self._session is not None:
+            self._session.close()
+
+
+_tablebases = dict()
+
+
+def open_tablebase(syzygy_path=None, online=True):
+    # Shared by every game in the process using the same tables
+    key = (syzygy_path, online)
+    tb = _tablebases.get(key)
+    if tb is None:
+        tb = Tablebase(syzygy_path, online)
+        _tablebases[key] = tb
+    return tb
+
+
+def close_tablebases():
+    for tb in _tablebases.values():
+        tb.close()
+    _tablebases.clear()
@@ -4,20 +4,33 @@ import chess.svg
 import chess.pgn
 import chess.polyglot
 from random import shuffle, sample, seed
-from numpy.random import choice
-from cairosvg import svg2png
 import datetime
 import os
-from mastodon import Mastodon
-from time import sleep
+from time import sleep, monotonic
 import argparse
-import requests
 import json
 import io
+import asyncio
+import signal
+import sys
+import traceback
+import threading
+from concurrent.futures import Future
+from engines import shared_session, close_sessions, stoppable_analyse
+from analysiscache import open_cache, close_caches
+from openingbook import open_book, close_books
+from tablebase import open_tablebase, close_tablebases
+from postqueue import PostQueue
+from gamestate import GameStore, GameTracker
+from archive import open_archive, close_archives
+from speculation import Speculator
+from metrics import span, hook_session, trace_turn, before_turn
+from mirrors import Mirrors
 
 parser = argparse.ArgumentParser(description="Vote chess mastodon bot")
-parser.add_argument(help="Config filepath (json)",
-                    dest="config_file")
+parser.add_argument(help="Config filepath(s) (json). Each config is an "
+                    "independent game; all of them run in this process",
+                    dest="config_files", nargs="+")
 parser.add_argument("--debug", dest="debug", action="store_true",
                     help="do not post to mastodon, do print boards")
 parser.add_argument("--human-depth", type=int,
@@ -34,6 +47,9 @@ parser.add_argument("--polyglot",
 parser.add_argument("--claim50", dest="claim50", action="store_true",
                     help="Claim draws at 3-fold repetition and 50 moves, rather "
                     "than waiting for 5-fold repetition and 75 moves")
+parser.add_argument("--per-move-rating", dest="per_move", action="store_true",
+                    help="Rate candidate moves with one search per move rather "
+                    "than a single MultiPV search")
 parser.add_argument("--board-scale", type=float, default = 2.0, dest="scale",
                     help="Scale for board (default: 2.0)")
 parser.add_argument("--usercred",
@@ -48,208 +64,93 @@ parser.add_argument("--no-check-api-version",
                        help=("Don't check API version. "
                              "Useful for other servers like GtS"),
                        dest="no_check_api", action="store_true")
+parser.add_argument("--daemon", dest="daemon", action="store_true",
+                    help="Keep running, playing each turn as its poll expires, "
+                    "rather than playing one turn and exiting")
 parser.add_argument("--no-start-game",
                        help=("Don't start a new game. "
                              "Only continue an existing one"),
                        dest="no_start_game", action="store_true")
 
-args = parser.parse_args()
-os.chdir(args.dir)
+book = ["e2e4", "d2d4", "g1f3", "c2c4", "g2g3"]
+# Daemon mode: seconds to wait after a poll's expires_at before counting it,
+# and before retrying a turn that failed
+POLL_GRACE = 10
+DAEMON_RETRY = 300
+# Longest wait for a posted status to become visible before replying to it
+READY_TIMEOUT = 50
+# Centipawn value of a mate when comparing screening scores
+MATE_SCORE = 100000
+# Screening depth when the screen block sets neither depth nor nodes
+SCREEN_DEPTH = 4
 
-ver_checkmode = "none" if args.no_check_api else "created"
-mastodon = Mastodon(
-    access_token = args.usercred_path,
-    api_base_url = args.server,
-    ratelimit_method='wait',
-    version_check_mode=ver_checkmode
-)
+# One pooled HTTP session per server, shared by the clients of every game
+# posting there
+_http_sessions = dict()
+# Engine searches are counted into `stats` dicts from the pool's threads
+_stats_lock = threading.Lock()
 
-configfp = args.config_file
 
-with open(configfp, "r") as configfile:
-    config = json.load(configfile)
+def tally(stats, name, n=1):
+    if stats is not None:
+        with _stats_lock:
+            stats[name] = stats.get(name, 0) + n
 
-seed()
-book = ["e2e4", "d2d4", "g1f3", "c2c4", "g2g3"]
-lastMove = None
-lastHuman = None
-limithuman = chess.engine.Limit(depth=config["human"].get("depth"))
-limitengine = chess.engine.Limit(depth=config["engine"].get("depth"))
-player = chess.WHITE
-lasttoot_id = None
-
-
-def save_config():
-    global config
-    global args
-    with open(args.config_file, "w") as configfile:
-        json.dump(config, configfile, indent=2)
-
-
-def pgn_standard_headers(pgn, player):
-    global config
-    pgn.headers["Date"] = datetime.date.today().strftime("%Y.%m.%d")
-    if config.get("site") is not None:
-        pgn.headers["Site"] = config.get("site")
-    pgn.headers["Event"] = "Vote chess: {}".format(config["name"])
-    if player == chess.WHITE:
-        pgn.headers["White"] = config["human"].get("name")
-        pgn.headers["Black"] = "{} (depth {})".format(
-            config["engine"].get("name"), config["engine"].get("depth"))
-    else:
-        pgn.headers["White"] = "{} (depth {})".format(
-            config["engine"].get("name"), config["engine"].get("depth"))
-        pgn.headers["Black"] = config["human"].get("name")
-    pgn.headers["Round"] = config.get("round")
-    return pgn
+
+def mastodon_client(server, usercred, check_api=True, timeout=300):
+    from mastodon import Mastodon
+    import requests
+    session = _http_sessions.get(server)
+    if session is None:
+        session = hook_session(requests.Session())
+        _http_sessions[server] = session
+    return Mastodon(
+        access_token = usercred,
+        api_base_url = server,
+        ratelimit_method='wait',
+        version_check_mode=("created" if check_api else "none"),
+        request_timeout=timeout,
+        session=session
+    )
 
 
 def opening_choice(board, bookfile, k=1):
     if k < 1:
         return [None]
-    bweights = []
-    bmoves = []
     try:
-        with chess.polyglot.open_reader(bookfile) as reader:
-            allbook = [e for e in reader.find_all(board)]
-            bweights = [e.weight for e in allbook]
-            bmoves = [e.move for e in allbook]
-            print("Opening book:")
-            for entry in reader.find_all(board):
-                print(entry.move, entry.weight, entry.learn)
-        if len(bmoves) > k:
-            sw = sum(bweights)
-            pweights = [b / sw for b in bweights]
-            chosen = choice(bmoves, k, replace = False, p=pweights)
-            return chosen
+        obook = open_book(bookfile)
+        with span("book_lookup"):
+            (bmoves, bweights, blearns) = obook.entries(board)
+        print("Opening book:")
+        for i in range(len(bmoves)):
+            print(bmoves[i], int(bweights[i]), blearns[i])
         if len(bmoves) > 0:
-            return(bmoves)
+            return obook.sample(board, k)
     except Exception as e:
         print("Failed to read opening book")
         print(e)
     return [None]
 
-def print_board(board, choices = None):
-    global player
-    global config
-    global args
-    lm = None
-    arrows = [] if choices is None or config.get("show_arrows") != True else [(move.from_square, move.to_square)
-                                           for move in choices if move != chess.Move.from_uci("0000")]
-    if len(board.move_stack) > 0:
-        lm = board.peek()
-    board_svg = chess.svg.board(board, flipped = (player == chess.BLACK),
-                                lastmove=lm,
-                                colors = config.get("board_colours"),
-                                arrows=arrows
-                               )
-    svg2png(bytestring=board_svg,write_to=config.get("image_file"),
-            scale=args.scale)
-
-
-def clean_endgame(board, lastMove, lastMbut1 = None, adjud = False):
-    global player
-    global mastodon
-    global lasttoot_id
-    global args
-    global config
-    print_board(board)
-    e_name = config["engine"].get("name")
-    if not args.debug:
-        img = mastodon.media_post(config.get("image_file"), description=
-                                  "Position after {}\nFEN: {}".format(
-                                      lastMove, board.fen()))
-    res = board.result(claim_draw=args.claim50)
-    if adjud:
-        res = "1/2-1/2"
-        config["human"]["score"] = config["human"]["score"] + 0.5
-        config["engine"]["score"] = config["engine"]["score"] + 0.5
-    egmsg = ""
-    if lastMove == "resignation":
-        egmsg = "The humans resign!\n"
-        config["engine"]["score"] = config["engine"]["score"] + 1.0
-        if board.turn == chess.WHITE:
-            res = "0-1"
-        else:
-            res = "1-0"
-    elif board.is_checkmate():
-        egmsg = "Checkmate!\n"
-        if lastMbut1 == None:
-            egmsg = egmsg + "With {} the humans win!\n".format(lastMove)
-            config["human"]["score"] = config["human"]["score"] + 1.0
-        else:
-            egmsg = egmsg + "{} replies to {} with {}\n".format(e_name, lastMbut1,
-                                                              lastMove)
-            config["engine"]["score"] = config["engine"]["score"] + 1.0
-    elif board.is_stalemate():
-        config["human"]["score"] = config["human"]["score"] + 0.5
-        config["engine"]["score"] = config["engine"]["score"] + 0.5
-        if lastMbut1 == None:
-            egmsg = egmsg + "With {} the humans stalemate the computer!\n".format(lastMove)
-        else:
-            egmsg = egmsg + "{} replies to {} with {}. Stalemate!\n".format(
-                e_name, lastMbut1, lastMove)
-    elif adjud:
-        config["human"]["score"] = config["human"]["score"] + 0.5
-        config["engine"]["score"] = config["engine"]["score"] + 0.5
-        if lastMbut1 == None:
-            egmsg = egmsg + ("After {} the position is adjudicated to a "
-                             "tablebase draw.\n").format(lastMove)
-        else:
-            egmsg = egmsg + "{} replies to {} with {}.\n".format(
-                e_name, lastMbut1, lastMove)
-            egmsg = egmsg + "The position is adjudicated to a tablebase draw.\n"
-        fenmod = board.fen().replace(" ", "_")
-        egmsg = egmsg + "https://syzygy-tables.info/?fen={}\n".format(fenmod)
-    else:
-        config["human"]["score"] = config["human"]["score"] + 0.5
-        config["engine"]["score"] = config["engine"]["score"] + 0.5
-        if lastMbut1 == None:
-            egmsg = egmsg + "With {} the humans claim a draw.\n".format(lastMove)
-        else:
-            egmsg = egmsg + "{} replies to {} with {}, and claims a draw.\n".format(
-                e_name, lastMbut1, lastMove)
-
-    pgn = chess.pgn.Game.from_board(board)
-    pgn.headers["Result"] = res
-    #egmsg = egmsg + res
-    egmsg = egmsg + ("Current score: {} {}, {} {}").format(
-        config["human"]["name"], config["human"]["score"],
-        config["engine"]["name"], config["engine"]["score"])
-    pgn = pgn_standard_headers(pgn, player)
-    print(egmsg)
-    if args.debug:
-        print(board)
-    else:
-        lasttoot_id = mastodon.status_post(egmsg,
-                                           in_reply_to_id=lasttoot_id,
-                                           media_ids=img,
-                                           visibility=("public" if lasttoot_id
-                                                       is None else
-                                                       "unlisted"))["id"]
-        config["postid"] = lasttoot_id
-    if config.get("archive_file") is not None:
-        arfile = config.get("archive_file")
-        if args.debug:
-            arfile = arfile + ".debug"
-        print(pgn, file=open(arfile, "a"), end="\n\n")
-    else:
-        print("No archive file!")
-        print(pgn)
-    config["pgn"] = None
-    config["human"]["colour"] = "WHITE" if config["human"].get("colour") == "BLACK" else "BLACK"
-    if args.hdist is not None:
-        config["human"]["depth"] = args.hdist
-    if args.edist is not None:
-        config["engine"]["depth"] = args.edist
-    if args.polyglot_book is not None:
-        config["polyglot_book"] = args.polyglot_book
-    config["poll_options"] = None
-    config["round"] = config.get("round") + 1
-    save_config()
-
-
-def eng_rate(legmoves, board, engine, lim):
+def cached_analyse(board, engine, lim, cache=None, stats=None):
+    # Returns (score relative to the player to move, best move) for a
+    # fixed-depth search, consulting the persistent analysis cache first
+    if cache is not None:
+        hit = cache.get(board, lim.depth)
+        if hit is not None:
+            return hit
+    tally(stats, "searches")
+    with span("engine_search", depth=lim.depth) as s:
+        info = stoppable_analyse(engine, board, lim)
+        s["nodes"] = info.get("nodes")
+    sc = info["score"].relative
+    bestmove = info["pv"][0] if len(info.get("pv", [])) > 0 else None
+    if cache is not None:
+        cache.put(board, lim.depth, sc, bestmove)
+    return (sc, bestmove)
+
+
+def eng_score_each(legmoves, board, engine, lim, cache=None, tablebase=None,
+                   stats=None):
     moves = list()
     for mv in legmoves:
         if bool(mv):
@@ -259,13 +160,118 @@ def eng_rate(legmoves, board, engine, lim):
             elif board.is_stalemate():
                 sc = chess.engine.Cp(0)
             else:
-                sc = engine.analyse(board,
-                                    lim)["score"].relative
+                sc = None if tablebase is None else tablebase.score(board)
+                if sc is None:
+                    sc = cached_analyse(board, engine, lim, cache, stats)[0]
             halfmove = board.halfmove_clock
             board.pop()
             moves.append((mv, sc, halfmove))
         else:
             moves.append((mv, chess.engine.Mate(0), 0))
+    return moves
+
+
+def eng_score_multipv(legmoves, board, engine, lim, width, cache=None,
+                      tablebase=None, stats=None):
+    # Returns (moves, unranked): ratings for the moves scored or shown in
+    # the MultiPV window, and for the moves searched but left outside it
+    moves = list()
+    searchmoves = list()
+    # A depth-N MultiPV line through a move is a depth N-1 search of the
+    # position after it, which is how those positions are cached
+    cdepth = lim.depth - 1 if lim.depth is not None and lim.depth > 1 else None
+    for mv in legmoves:
+        if bool(mv):
+            board.push(mv)
+            halfmove = board.halfmove_clock
+            if board.is_checkmate():
+                moves.append((mv, chess.engine.Mate(-0), halfmove))
+            elif board.is_stalemate():
+                moves.append((mv, chess.engine.Cp(0), halfmove))
+            else:
+                hit = None
+                if tablebase is not None:
+                    sc = tablebase.score(board)
+                    hit = None if sc is None else (sc, None)
+                if hit is None and cache is not None:
+                    hit = cache.get(board, cdepth)
+                if hit is None:
+                    searchmoves.append((mv, halfmove))
+                else:
+                    moves.append((mv, hit[0], halfmove))
+            board.pop()
+        else:
+            moves.append((mv, chess.engine.Mate(0), 0))
+    if len(searchmoves) == 0:
+        return (moves, [])
+    if width < 1 or width > len(searchmoves):
+        width = len(searchmoves)
+    tally(stats, "searches")
+    with span("engine_search", depth=lim.depth, multipv=width) as s:
+        infos = stoppable_analyse(engine, board, lim, multipv=width,
+                                  root_moves=[mv for (mv, _) in searchmoves])
+        s["nodes"] = infos[0].get("nodes") if len(infos) > 0 else None
+    # Scores are relative to the player to move in the parent position, so
+    # take them from the other side to match the per-move (child) ratings
+    ranked = {info["pv"][0]: (info["score"].pov(not board.turn), info["pv"])
+              for info in infos if "pv" in info and "score" in info}
+    if cache is not None:
+        for (mv, (sc, pv)) in ranked.items():
+            board.push(mv)
+            cache.put(board, cdepth, sc, pv[1] if len(pv) > 1 else None)
+            board.pop()
+    # Moves outside the MultiPV window are no better than the worst line
+    # shown; they take its score, but rank after every line
+    worst = max([sc for (sc, _) in ranked.values()] or [chess.engine.Cp(0)])
+    unranked = list()
+    for (mv, halfmove) in searchmoves:
+        if mv in ranked:
+            moves.append((mv, ranked[mv][0], halfmove))
+        else:
+            unranked.append((mv, worst, halfmove))
+    return (moves, unranked)
+
+
+def eng_rate(legmoves, board, engines, lim, multipv=None, cache=None,
+             tablebase=None, stats=None):
+    # multipv=None rates each move with its own search of the child position;
+    # otherwise one MultiPV search of the parent ranks up to `multipv` moves
+    # (0 for all of them). The moves are dealt round-robin across the engine
+    # pool and each shard is searched concurrently on its own process. A
+    # narrower MultiPV window stays on one process: shards would each show
+    # their own best lines, and which of the lines tied at the edge of the
+    # window make it in is the engine's choice, so no merge of them is sure
+    # to match a single search. `stats`, if given, counts the engine searches
+    # made under "searches".
+    legmoves = list(legmoves)
+    nshards = max(1, min(engines.size, len(legmoves)))
+    if multipv is not None and multipv > 0:
+        nshards = 1
+    shards = [legmoves[i::nshards] for i in range(nshards)]
+    if multipv is None:
+        rate = lambda engine, shard: (eng_score_each(shard, board.copy(),
+                                                     engine, lim, cache,
+                                                     tablebase, stats), [])
+    else:
+        rate = lambda engine, shard: eng_score_multipv(shard, board.copy(),
+                                                       engine, lim, multipv,
+                                                       cache, tablebase, stats)
+    results = engines.map(rate, shards)
+    order = {mv: i for (i, mv) in enumerate(legmoves)}
+    moves = rank_moves([m for (ratings, _) in results for m in ratings], order)
+    # Moves the MultiPV search did not rank go last, whatever their halfmove
+    # clock
+    unranked = [m for (_, rest) in results for m in rest]
+    return moves + rank_moves(unranked, order)
+
+
+def rank_moves(moves, order):
+    # Best first, for the player to move; `order` is each move's index in
+    # the candidate list
+    moves = list(moves)
+    # Restore the candidate order so that ties sort exactly as they would
+    # with a single engine
+    moves.sort(key = lambda tup: order[tup[0]])
     # First sort by halfmoves, i.e. rank moves that capture or move a pawn
     # ahead
     moves.sort(key = lambda tup: tup[2])
@@ -278,282 +284,850 @@ def eng_rate(legmoves, board, engine, lim):
     return moves
 
 
-def eng_choose(legmoves, board, lim):
-    global config
-    # global args
-    # if board.fullmove_number < 10 and args.polyglot_book != "":
-    #     opc = opening_choice(board, args.polyglot_book)
-    #     if opc is not None:
-    #         return opc
-
-    engine = chess.engine.SimpleEngine.popen_uci(config["engine"].get("path"))
-    moves = eng_rate(legmoves, board, engine, lim)
-    engine.quit()
-    return moves[0][0]
-
-
-def set_up_vote(last_Comp_Move, curBoard, lastHuman=None):
-    global mastodon
-    global lasttoot_id
-    global args
-    global config
-    global limithuman
-    curlegmoves = [m for m in curBoard.legal_moves]
-    moves = []
-    if curBoard.fullmove_number < 10 and config.get("polyglot_book") is not None:
-        moves = [m for m in opening_choice(curBoard, config["polyglot_book"], 4)]
-        if moves[0] is None:
-            moves = []
-    if len(moves) < len(curlegmoves) and len(moves) < 5:
-        engine = chess.engine.SimpleEngine.popen_uci(config["engine"].get("path"))
-        emovs = eng_rate([mov for mov in curlegmoves if mov not in moves], curBoard, engine, limithuman)
-        moves = moves + [m[0] for m in emovs]
-        engine.quit()
-        # resign if more than 5 pawn-equivalents down
-        if emovs[0][1] > chess.engine.Cp(500):
-            moves = [chess.Move.null()] + moves
-    if len(moves) < 5:
-        options = moves
-    else:
-        options = moves[:4] # Get four best, not top 3 and bottom 1
-        # options = moves[:3]
-        # options.extend(moves[-1:])
-    shuffle(options)
-    print_board(curBoard, choices=options)
-    if not args.debug:
-        img = mastodon.media_post(config.get("image_file"), description=
-                                  "Position after {}\nFEN: {}".format(
-                                      last_Comp_Move, curBoard.fen()))
-
-    tootstring = ""
-
-    # For now, just print to stdout
-    if lastHuman == None:
-        tootstring = "New Game vs {}\n".format(config["engine"].get("name"))
-    else:
-        tootstring = "Poll result: {}\n".format(lastHuman)
-    if last_Comp_Move != None:
-        tootstring = tootstring + "{}'s move: {}".format(
-            config["engine"].get("name"), last_Comp_Move)
+def eng_rate_staged(legmoves, board, engines, lim, screen, multipv=None,
+                    cache=None, tablebase=None, stats=None):
+    # Rate every move with a cheap screening search (screen["depth"] and/or
+    # screen["nodes"], SCREEN_DEPTH if neither is set), drop the moves more
+    # than screen["margin"] centipawns worse than the best, and search only
+    # the best screen["finalists"] of the rest at `lim`. The finalists come
+    # first, in eng_rate order; the other moves follow in their screening
+    # order. `stats`, if given, counts the moves screened, searched in full
+    # and pruned, and the full-depth engine searches made.
+    legmoves = list(legmoves)
+    (depth, nodes) = (screen.get("depth"), screen.get("nodes"))
+    if depth is None and nodes is None:
+        depth = SCREEN_DEPTH
+    screenlim = chess.engine.Limit(depth=depth, nodes=nodes)
+    # The cache is keyed by depth, so node-limited screens bypass it
+    screened = eng_rate(legmoves, board, engines, screenlim, multipv,
+                        cache if screenlim.nodes is None else None, tablebase)
+    best = screened[0][1].score(mate_score=MATE_SCORE)
+    margin = screen.get("margin")
+    survivors = [m for (m, sc, _) in screened
+                 if margin is None
+                 or sc.score(mate_score=MATE_SCORE) - best <= margin]
+    finalists = survivors[:max(1, screen.get("finalists", 6))]
+    moves = eng_rate(finalists, board, engines, lim, multipv, cache,
+                     tablebase, stats)
+    moves = moves + [m for m in screened if m[0] not in finalists]
+    if stats is not None:
+        stats["screened"] = stats.get("screened", 0) + len(legmoves)
+        stats["deep"] = stats.get("deep", 0) + len(finalists)
+        stats["pruned"] = stats.get("pruned", 0) + len(legmoves) - len(survivors)
+    return moves
 
-    print(tootstring)
 
-    if args.debug:
-        print(curBoard)
-    else:
-        lasttoot_id = mastodon.status_post(tootstring,
-                                           in_reply_to_id=lasttoot_id,
-                                           media_ids=img,
-                                           visibility=("public" if lasttoot_id
-                                                       is None else
-                                                       "unlisted"))["id"]
-        sleep(50)
-    tootstring = ""
-    if len(options) == 1:
-        tootstring = "Only one legal move: {}".format(
-              board.variation_san([options[0]]))
-        if not args.debug:
-            lasttoot_id = mastodon.status_post(tootstring,
-                                               in_reply_to_id=lasttoot_id,
-                                               visibility=("public" if
-                                                           lasttoot_id is None
-                                                           else
-                                                           "unlisted"))["id"]
-            config["postid"] = lasttoot_id
+class VoteChessGame:
+    # All the state of one game, driven by its own config file. The engine
+    # pool, opening books, renderer and HTTP sessions are shared between the
+    # games in a process.
+
+    def __init__(self, configfp, args):
+        self.configfp = configfp
+        self.args = args
+        # Spans recorded between turns, for the next turn's trace
+        self.pre_turn = None
+        self.reload_config()
+        self.name = self.config.get("name", configfp)
+        # Built on first use: debug runs, and runs that stop before posting,
+        # never load Mastodon.py
+        self._mastodon = None
+        self.engine_session = shared_session(self.config["engine"])
+        self.analysis_cache = None
+        if self.config.get("analysis_cache") is not None:
+            self.analysis_cache = open_cache(self.config["analysis_cache"],
+                                             self.config["engine"].get("name"))
+        # Local Syzygy tables if configured, lichess.ovh as the fallback
+        self.tablebase = open_tablebase(self.config.get("syzygy_path"),
+                                        self.config.get("tablebase_online", True))
+        # Uploads and posts run here, overlapping the analysis
+        self.posts = PostQueue(self.config.get("post_interval", 0))
+        # Daemon mode: analysis of the open poll's options, run until it closes
+        self.speculation = Speculator()
+        # Other instances that get the same posts and polls, whose votes are
+        # added to the primary's
+        self.mirrors = Mirrors(
+            [(m["server"], lambda m=m: mastodon_client(
+                m["server"], m.get("usercred", args.usercred_path),
+                m.get("check_api", False), self.config.get("mirror_timeout", 20)))
+             for m in self.config.get("mirrors", [])],
+            self.config.get("mirror_timeout", 20),
+            self.config.get("post_interval", 0), self.config.get("mirror_ids"),
+            lambda ids: self.config.__setitem__("mirror_ids", ids))
+        self.lastMove = None
+        # Repetition counts for the game in progress, set by load_game
+        self.tracker = None
+        # Moves screened, searched in full and pruned by eng_rate_staged
+        self.screen_stats = dict()
+        self.limithuman = None
+        self.limitengine = None
+        self.player = chess.WHITE
+        self.lasttoot_id = None
+        # Set when there is no game and --no-start-game forbids a new one
+        self.stopped = False
+
+    @property
+    def mastodon(self):
+        if self._mastodon is None:
+            self._mastodon = mastodon_client(
+                self.config.get("server", self.args.server),
+                self.config.get("usercred", self.args.usercred_path),
+                not self.args.no_check_api)
+        return self._mastodon
+
+    @mastodon.setter
+    def mastodon(self, client):
+        self._mastodon = client
+
+    def load_config(self):
+        with span("config_load"):
+            with open(self.configfp, "r") as configfile:
+                config = json.load(configfile)
+        # The game in progress lives in its own store; the config is only
+        # rewritten between games
+        self.state = GameStore(config.get(
+            "state_file", os.path.splitext(self.configfp)[0] + ".state"))
+        return self.state.overlay(config)
+
+    def reload_config(self):
+        # Outside a turn: the load is traced as part of the next one
+        with before_turn(self.pre_turn) as self.pre_turn:
+            self.config = self.load_config()
+
+    def save_config(self):
+        tmp = self.configfp + ".tmp"
+        with open(tmp, "w") as configfile:
+            json.dump(self.config, configfile, indent=2)
+        os.replace(tmp, self.configfp)
+
+    def pgn_standard_headers(self, pgn, player):
+        pgn.headers["Date"] = datetime.date.today().strftime("%Y.%m.%d")
+        if self.config.get("site") is not None:
+            pgn.headers["Site"] = self.config.get("site")
+        pgn.headers["Event"] = "Vote chess: {}".format(self.config["name"])
+        if player == chess.WHITE:
+            pgn.headers["White"] = self.config["human"].get("name")
+            pgn.headers["Black"] = "{} (depth {})".format(
+                self.config["engine"].get("name"), self.config["engine"].get("depth"))
         else:
-            print(tootstring)
-            config["postid"] = None
-        config["poll_options"] = None
-    else:
-        tootstring = "Options:\n"
-        for i in range(len(options)):
-            tootstring = tootstring + "{}) {}\n".format(i+1, curBoard.variation_san([options[i]]) if
-                              bool(options[i]) else "Resign")
-        opstrings = [(curBoard.san(mv) if bool(mv) else "Resign") for mv in options]
-        config["poll_options"] = opstrings
-        if not args.debug:
-            poll = mastodon.make_poll(opstrings, expires_in = config.get("poll_length"))
-
-        if last_Comp_Move == None:
-            tmsg = "Choose a move to play:"
+            pgn.headers["White"] = "{} (depth {})".format(
+                self.config["engine"].get("name"), self.config["engine"].get("depth"))
+            pgn.headers["Black"] = self.config["human"].get("name")
+        pgn.headers["Round"] = self.config.get("round")
+        return pgn
+
+    def print_board(self, board, choices = None):
+        lm = None
+        arrows = [] if choices is None or self.config.get("show_arrows") != True else [(move.from_square, move.to_square)
+                                               for move in choices if move != chess.Move.from_uci("0000")]
+        if len(board.move_stack) > 0:
+            lm = board.peek()
+        with span("render", renderer=self.config.get("renderer", "svg")):
+            if self.config.get("renderer") == "sprites":
+                from render import sprite_renderer
+                renderer = sprite_renderer(self.args.scale, self.config.get("board_colours"),
+                                           self.config.get("sprite_dir", "sprites"))
+                png = renderer.render(board, flipped = (self.player == chess.BLACK),
+                                      lastmove=lm, arrows=arrows)
+            else:
+                from cairosvg import svg2png
+                board_svg = chess.svg.board(board, flipped = (self.player == chess.BLACK),
+                                            lastmove=lm,
+                                            colors = self.config.get("board_colours"),
+                                            arrows=arrows
+                                           )
+                png = svg2png(bytestring=board_svg, scale=self.args.scale)
+        if self.args.debug:
+            with open(self.config.get("image_file"), "wb") as imgfile:
+                imgfile.write(png)
+        return png
+
+    def clean_endgame(self, board, lastMove, lastMbut1 = None, adjud = False):
+        img = self.upload_board(board, lastMove)
+        e_name = self.config["engine"].get("name")
+        res = self.tracker.result(self.args.claim50)
+        if adjud:
+            # Scored with the message below
+            res = "1/2-1/2"
+        egmsg = ""
+        if lastMove == "resignation":
+            egmsg = "The humans resign!\n"
+            self.config["engine"]["score"] = self.config["engine"]["score"] + 1.0
+            if board.turn == chess.WHITE:
+                res = "0-1"
+            else:
+                res = "1-0"
+        elif board.is_checkmate():
+            egmsg = "Checkmate!\n"
+            if lastMbut1 == None:
+                egmsg = egmsg + "With {} the humans win!\n".format(lastMove)
+                self.config["human"]["score"] = self.config["human"]["score"] + 1.0
+            else:
+                egmsg = egmsg + "{} replies to {} with {}\n".format(e_name, lastMbut1,
+                                                                  lastMove)
+                self.config["engine"]["score"] = self.config["engine"]["score"] + 1.0
+        elif board.is_stalemate():
+            self.config["human"]["score"] = self.config["human"]["score"] + 0.5
+            self.config["engine"]["score"] = self.config["engine"]["score"] + 0.5
+            if lastMbut1 == None:
+                egmsg = egmsg + "With {} the humans stalemate the computer!\n".format(lastMove)
+            else:
+                egmsg = egmsg + "{} replies to {} with {}. Stalemate!\n".format(
+                    e_name, lastMbut1, lastMove)
+        elif adjud:
+            self.config["human"]["score"] = self.config["human"]["score"] + 0.5
+            self.config["engine"]["score"] = self.config["engine"]["score"] + 0.5
+            if lastMbut1 == None:
+                egmsg = egmsg + ("After {} the position is adjudicated to a "
+                                 "tablebase draw.\n").format(lastMove)
+            else:
+                egmsg = egmsg + "{} replies to {} with {}.\n".format(
+                    e_name, lastMbut1, lastMove)
+                egmsg = egmsg + "The position is adjudicated to a tablebase draw.\n"
+            fenmod = board.fen().replace(" ", "_")
+            egmsg = egmsg + "https://syzygy-tables.info/?fen={}\n".format(fenmod)
         else:
-            tmsg = ("Choose a move to reply to {}:").format(last_Comp_Move)
-
-        if not args.debug:
-            lasttoot_id = mastodon.status_post(tmsg, poll=poll,
-                                               in_reply_to_id=lasttoot_id,
-                                               visibility=("public" if
-                                                           lasttoot_id is None
-                                                           else
-                                                           "unlisted"))["id"]
-            config["postid"] = lasttoot_id
+            self.config["human"]["score"] = self.config["human"]["score"] + 0.5
+            self.config["engine"]["score"] = self.config["engine"]["score"] + 0.5
+            if lastMbut1 == None:
+                egmsg = egmsg + "With {} the humans claim a draw.\n".format(lastMove)
+            else:
+                egmsg = egmsg + "{} replies to {} with {}, and claims a draw.\n".format(
+                    e_name, lastMbut1, lastMove)
+
+        pgn = chess.pgn.Game.from_board(board)
+        pgn.headers["Result"] = res
+        #egmsg = egmsg + res
+        egmsg = egmsg + ("Current score: {} {}, {} {}").format(
+            self.config["human"]["name"], self.config["human"]["score"],
+            self.config["engine"]["name"], self.config["engine"]["score"])
+        pgn = self.pgn_standard_headers(pgn, self.player)
+        print(egmsg)
+        if self.args.debug:
+            img.result()
+            print(board)
         else:
-            print(tmsg)
-            print(tootstring)
-            config["postid"] = None
-
-
-def get_vote_results(curBoard):
-    global lasttoot_id
-    global mastodon
-    global limitengine
-    # For now, just select best move
-    if lasttoot_id is None:
-        print("No poll")
-        return eng_choose(curBoard.legal_moves, curBoard, limitengine)
-    try:
-        print(lasttoot_id)
-        poll = mastodon.status(id = lasttoot_id)["poll"]
-        print("Got poll")
-        votes = [mv["votes_count"] for mv in poll["options"]]
-        mvotes = max(votes)
-        choices = [(curBoard.parse_san(mv["title"]) if mv["title"] != "Resign"
-                   else chess.Move.null()) for mv in poll["options"] if
-                   mv["votes_count"] == mvotes]
-        return eng_choose(choices, curBoard, limitengine)
-    except Exception as e:
-        print("Failed to get poll results")
-        print(e)
-        return eng_choose(curBoard.legal_moves, curBoard, limitengine)
-
-
-def load_game():
-    global player
-    global lastMove
-    global book
-    global lasttoot_id
-    global mastodon
-    global args
-    global config
-    # 1. Test if game exists, is not ended
-    newGame = False
-    lasttoot_id = config.get("postid")
-    try:
-        pgn = io.StringIO(config.get("pgn"))
-        curGame = chess.pgn.read_game(pgn)
-        board = curGame.end().board()
-        # If exists but is ended, archive, continue
-        if board.is_game_over(claim_draw=args.claim50):
-            newGame = True
-            if config.get("archive_file") is not None:
-                arfile = config.get("archive_file")
-                if args.debug:
-                    arfile = arfile + ".debug"
-                print(curGame, file=open(arfile, "a"), end="\n\n")
+            self.lasttoot_id = self.posts.submit(
+                self.status_post,
+                egmsg, in_reply_to_id=self.lasttoot_id, media_ids=img.result(),
+                visibility=("public" if self.lasttoot_id is None
+                            else "unlisted")).result()["id"]
+            self.config["postid"] = self.lasttoot_id
+        self.archive_game(pgn)
+        self.state.clear()
+        self.config["human"]["colour"] = "WHITE" if self.config["human"].get("colour") == "BLACK" else "BLACK"
+        if self.args.hdist is not None:
+            self.config["human"]["depth"] = self.args.hdist
+        if self.args.edist is not None:
+            self.config["engine"]["depth"] = self.args.edist
+        if self.args.polyglot_book is not None:
+            self.config["polyglot_book"] = self.args.polyglot_book
+        self.config["poll_options"] = None
+        self.config["poll_expires"] = None
+        self.config["round"] = self.config.get("round") + 1
+        self.save_config()
+
+    def multipv_width(self, player_config):
+        if self.args.per_move:
+            return None
+        return player_config.get("multipv", 0)
+
+    def eng_choose(self, legmoves, board, lim):
+        # if board.fullmove_number < 10 and self.args.polyglot_book != "":
+        #     opc = opening_choice(board, self.args.polyglot_book)
+        #     if opc is not None:
+        #         return opc
+
+        moves = eng_rate(legmoves, board, self.engine_session, lim,
+                         self.multipv_width(self.config["engine"]),
+                         self.analysis_cache, self.tablebase)
+        return moves[0][0]
+
+    def rate_candidates(self, curBoard, candidates, cache=None, stats=None):
+        screen = self.config["human"].get("screen")
+        if screen is not None:
+            return eng_rate_staged(candidates, curBoard, self.engine_session,
+                                   self.limithuman, screen,
+                                   self.multipv_width(self.config["human"]),
+                                   cache, self.tablebase, stats)
+        return eng_rate(candidates, curBoard, self.engine_session,
+                        self.limithuman,
+                        self.multipv_width(self.config["human"]), cache,
+                        self.tablebase)
+
+    def candidate_options(self, curBoard):
+        curlegmoves = [m for m in curBoard.legal_moves]
+        moves = []
+        if curBoard.fullmove_number < 10 and self.config.get("polyglot_book") is not None:
+            moves = [m for m in opening_choice(curBoard, self.config["polyglot_book"], 4)]
+            if moves[0] is None:
+                moves = []
+        if len(moves) < len(curlegmoves) and len(moves) < 5:
+            emovs = None
+            if len(moves) == 0:
+                emovs = self.speculation.get("candidates", curBoard)
+            if emovs is None:
+                emovs = self.rate_candidates(
+                    curBoard, [mov for mov in curlegmoves if mov not in moves],
+                    self.analysis_cache, self.screen_stats)
+            moves = moves + [m[0] for m in emovs]
+            # resign if more than 5 pawn-equivalents down
+            if emovs[0][1] > chess.engine.Cp(500):
+                moves = [chess.Move.null()] + moves
+        if len(moves) < 5:
+            options = moves
+        else:
+            options = moves[:4] # Get four best, not top 3 and bottom 1
+            # options = moves[:3]
+            # options.extend(moves[-1:])
+        shuffle(options)
+        return options
+
+    def upload_board(self, board, lastMove, choices=None):
+        # Render and upload the board on the post queue, so it overlaps with
+        # whatever the caller does next. Returns a future for the media
+        # attachment (for the rendered PNG in debug mode).
+        rendered = self.posts.submit(self.print_board, board, choices)
+        if self.args.debug:
+            return rendered
+        return self.posts.submit(
+            lambda: self.media_post(
+                io.BytesIO(rendered.result()), mime_type="image/png",
+                description="Position after {}\nFEN: {}".format(
+                    lastMove, board.fen()),
+                synchronous=True))
+
+    def media_post(self, media_file, *args, **kwargs):
+        if len(self.mirrors) == 0:
+            with span("media_upload"):
+                return self.mastodon.media_post(media_file, *args, **kwargs)
+        data = media_file.read()
+        uploaded = Future()
+        self.mirrors.media_post(uploaded, data, args, kwargs)
+        try:
+            with span("media_upload"):
+                media = self.mastodon.media_post(io.BytesIO(data), *args, **kwargs)
+        except BaseException as e:
+            uploaded.set_exception(e)
+            raise
+        uploaded.set_result(media["id"])
+        return media
+
+    def status_post(self, *args, **kwargs):
+        posted = Future()
+        self.mirrors.status_post(posted, args, kwargs)
+        try:
+            with span("status_post"):
+                status = self.mastodon.status_post(*args, **kwargs)
+        except BaseException as e:
+            posted.set_exception(e)
+            raise
+        posted.set_result(status["id"])
+        return status
+
+    def post_board(self, board, lastMove, text, choices=None, img=None):
+        # As upload_board (unless given its future as `img`), then post `text`
+        # with the image; returns a future for the posted status
+        if img is None:
+            img = self.upload_board(board, lastMove, choices)
+        if self.args.debug:
+            return img
+        inreply = self.lasttoot_id
+        return self.posts.submit(
+            lambda: self.status_post(
+                text, in_reply_to_id=inreply, media_ids=img.result(),
+                visibility=("public" if inreply is None else "unlisted")))
+
+    def wait_until_visible(self, status_id):
+        # Replaces a fixed sleep before replying: back off until the server
+        # serves the status, up to READY_TIMEOUT seconds
+        from mastodon import MastodonNotFoundError
+        delay = 1
+        deadline = monotonic() + READY_TIMEOUT
+        while True:
+            try:
+                self.mastodon.status(id = status_id)
+                return True
+            except MastodonNotFoundError:
+                if monotonic() + delay > deadline:
+                    return False
+                sleep(delay)
+                delay = min(2 * delay, 8)
+
+    def set_up_vote(self, last_Comp_Move, curBoard, lastHuman=None):
+        self.config["poll_expires"] = None
+        tootstring = ""
+
+        # For now, just print to stdout
+        if lastHuman == None:
+            tootstring = "New Game vs {}\n".format(self.config["engine"].get("name"))
+        else:
+            tootstring = "Poll result: {}\n".format(lastHuman)
+        if last_Comp_Move != None:
+            tootstring = tootstring + "{}'s move: {}".format(
+                self.config["engine"].get("name"), last_Comp_Move)
+
+        # Without arrows the image does not depend on the options, so it is
+        # rendered and uploaded while the candidates are analysed. It is only
+        # posted once they are, so a failed analysis leaves no status behind.
+        img = None
+        if self.config.get("show_arrows") != True:
+            img = self.upload_board(curBoard, last_Comp_Move)
+        options = self.candidate_options(curBoard)
+        posted = self.post_board(curBoard, last_Comp_Move, tootstring, options,
+                                 img)
+
+        print(tootstring)
+
+        if self.args.debug:
+            posted.result()
+            print(curBoard)
+        else:
+            self.lasttoot_id = posted.result()["id"]
+            self.posts.submit(self.wait_until_visible, self.lasttoot_id)
+        tootstring = ""
+        if len(options) == 1:
+            tootstring = "Only one legal move: {}".format(
+                  curBoard.variation_san([options[0]]))
+            if not self.args.debug:
+                self.lasttoot_id = self.posts.submit(
+                    self.status_post,
+                    tootstring, in_reply_to_id=self.lasttoot_id,
+                    visibility=("public" if self.lasttoot_id is None
+                                else "unlisted")).result()["id"]
+                self.config["postid"] = self.lasttoot_id
             else:
-                print("No archive file!")
-                print(pgn)
-            config["pgn"] = None
+                print(tootstring)
+                self.config["postid"] = None
+            self.config["poll_options"] = None
         else:
-            player = board.turn
-            lastMove = None
-            if len(board.move_stack) > 0:
-                lastMove = board.peek()
-    except:
-        newGame = True
-    if newGame:
-        if args.no_start_game:
-            print("No game but flag set to not start new game; aborting")
-            if lasttoot_id is not None and not args.debug:
-                egmsg = "That's all folks!"
-                print(egmsg)
-                mastodon.status_post(egmsg,
-                                     in_reply_to_id=lasttoot_id,
-                                     visibility=("unlisted"))
-                config["postid"] = None
-                save_config()
-            quit()
+            tootstring = "Options:\n"
+            for i in range(len(options)):
+                tootstring = tootstring + "{}) {}\n".format(i+1, curBoard.variation_san([options[i]]) if
+                                  bool(options[i]) else "Resign")
+            opstrings = [(curBoard.san(mv) if bool(mv) else "Resign") for mv in options]
+            self.config["poll_options"] = opstrings
+            if not self.args.debug:
+                poll = self.mastodon.make_poll(opstrings, expires_in = self.config.get("poll_length"))
+
+            if last_Comp_Move == None:
+                tmsg = "Choose a move to play:"
+            else:
+                tmsg = ("Choose a move to reply to {}:").format(last_Comp_Move)
+
+            if not self.args.debug:
+                status = self.posts.submit(
+                    self.status_post,
+                    tmsg, poll=poll, in_reply_to_id=self.lasttoot_id,
+                    visibility=("public" if self.lasttoot_id is None
+                                else "unlisted")).result()
+                self.lasttoot_id = status["id"]
+                self.config["postid"] = self.lasttoot_id
+                if status.get("poll") is not None:
+                    self.config["poll_expires"] = status["poll"]["expires_at"].isoformat()
+            else:
+                print(tmsg)
+                print(tootstring)
+                self.config["postid"] = None
+
+    def get_vote_results(self, curBoard):
+        # For now, just select best move
+        if self.lasttoot_id is None:
+            print("No poll")
+            return self.eng_choose(curBoard.legal_moves, curBoard, self.limitengine)
+        try:
+            print(self.lasttoot_id)
+            with span("poll_fetch"):
+                poll = self.mastodon.status(id = self.lasttoot_id)["poll"]
+            print("Got poll")
+            counts = {mv["title"]: mv["votes_count"] or 0 for mv in poll["options"]}
+            if len(self.mirrors) > 0:
+                with span("poll_fetch", mirrors=len(self.mirrors)):
+                    for (title, n) in self.mirrors.votes(self.lasttoot_id).items():
+                        if title in counts:
+                            counts[title] += n
+            mvotes = max(counts.values())
+            choices = [(curBoard.parse_san(title) if title != "Resign"
+                       else chess.Move.null()) for (title, n) in counts.items()
+                       if n == mvotes]
+            # Break ties with the options' speculative ranking, if there is one
+            ranking = self.speculation.get("ranking", curBoard)
+            if ranking is not None:
+                ranked = [mv for mv in ranking if mv in choices]
+                if len(ranked) > 0:
+                    return ranked[0]
+            return self.eng_choose(choices, curBoard, self.limitengine)
+        except Exception as e:
+            print("Failed to get poll results")
+            print(e)
+            return self.eng_choose(curBoard.legal_moves, curBoard, self.limitengine)
+
+    def import_pgn(self):
+        # Configs from before the game-state store kept the game as PGN;
+        # move it into the store once
+        if self.config.get("pgn") is None or self.state.exists():
+            return
+        curGame = chess.pgn.read_game(io.StringIO(self.config.get("pgn")))
+        if curGame is not None:
+            self.state.start(curGame.end().board(), self.config)
+        self.config["pgn"] = None
+        self.save_config()
+
+    def archive_game(self, pgn):
+        if self.config.get("archive_file") is not None:
+            arfile = self.config.get("archive_file")
+            if self.args.debug:
+                arfile = arfile + ".debug"
+            open_archive(arfile).append(pgn)
         else:
-            # Create new game
-            lasttoot_id = None
-            config["postid"] = None
-            lastMove = None
-            board = chess.Board()
-            player = chess.BLACK if config["human"].get("colour") == "BLACK" else chess.WHITE
-            lastMoveSan = None
-            if player == chess.BLACK:
-                lastMove = None
-                if config.get("polyglot_book") is not None:
-                    lastMove = opening_choice(board, config.get("polyglot_book"))[0]
-                if lastMove is None:
-                    lastMove = chess.Move.from_uci(sample(book, 1)[0])
-                lastMoveSan = board.variation_san([lastMove])
-                board.push(lastMove)
-            set_up_vote(lastMoveSan, board, None)
-            pgn = chess.pgn.Game.from_board(board)
-            pgn.headers["Result"] = "*"
-            pgn = pgn_standard_headers(pgn, player)
+            print("No archive file!")
             print(pgn)
-            config["pgn"] = str(pgn)
-            save_config()
-            quit()
-    return board
-
-
-board = load_game()
-legmovs = list(board.legal_moves)
-# 3. If only one legal move, just make it
-if len(legmovs) == 1:
-    humMove = legmovs[0]
-else:
-    # 4. Otherwise, gather results from thread for game. If tie, break with engine analysis, make move
-    humMove = get_vote_results(board)
-
-if bool(humMove):
-    humMoveSan = board.variation_san([humMove])
-    board.push(humMove)
-else:
-    humMoveSan = "resignation"
-
-if not board.is_game_over(claim_draw=args.claim50) and bool(humMove):
-    # 6. Make engine move
-    # legmovs = list(board.legal_moves)
-    # engmov = eng_choose()
-    engmov = None
-    if board.fullmove_number < 10 and config.get("polyglot_book") is not None:
-        engmov = opening_choice(board, config.get("polyglot_book"))[0]
-
-    if engmov is None:
-        engine = chess.engine.SimpleEngine.popen_uci(config["engine"].get("path"))
-        engmov = engine.play(board, limitengine).move
-        engine.quit()
-
-    lastMove = engmov
-    lastMoveSan = board.variation_san([lastMove])
-    board.push(engmov)
-    if not board.is_game_over(claim_draw=args.claim50):
+
+    def load_game(self):
+        # 1. Test if game exists, is not ended
+        newGame = False
+        self.lasttoot_id = self.config.get("postid")
         try:
-            if board.halfmove_clock > 20 or board.halfmove_clock < 2:
-                if len(board.piece_map()) < 8:
-                    fenmod = board.fen().replace(" ", "_")
-                    apiurl = "http://tablebase.lichess.ovh/standard?fen="
-                    r = requests.get(url="{}{}".format(apiurl, fenmod),
-                                     timeout=10)
-                    res = r.json()
-                    if res.get("wdl") == 0 or res.get("category") == "draw":
-                        print("Tablebase draw")
-                        clean_endgame(board, lastMoveSan, humMoveSan, True)
-                        quit()
+            with span("game_load"):
+                self.import_pgn()
+                board = self.state.load()
+                if board is not None:
+                    self.tracker = self.state.tracker(board)
+            if board is None:
+                newGame = True
+            # If exists but is ended, archive, continue
+            elif self.tracker.is_game_over(self.args.claim50):
+                newGame = True
+                pgn = chess.pgn.Game.from_board(board)
+                pgn.headers["Result"] = self.tracker.result(self.args.claim50)
+                pgn = self.pgn_standard_headers(
+                    pgn, chess.BLACK if self.config["human"].get("colour") == "BLACK" else chess.WHITE)
+                self.archive_game(pgn)
+                self.state.clear()
+            else:
+                self.player = board.turn
+                self.lastMove = None
+                if len(board.move_stack) > 0:
+                    self.lastMove = board.peek()
         except Exception as e:
-            print("Failed to get adjudication")
+            print("Failed to load game")
             print(e)
-        set_up_vote(lastMoveSan, board, humMoveSan)
-        # Save board
-        print("saving")
-        pgn = chess.pgn.Game.from_board(board)
-        pgn.headers["Result"] = "*"
-        pgn = pgn_standard_headers(pgn, player)
-        # print(pgn)
-        config["pgn"] = str(pgn)
-        save_config()
-    else:
-        clean_endgame(board, lastMoveSan, humMoveSan)
-else:
-    clean_endgame(board, humMoveSan, None)
+            newGame = True
+        if newGame:
+            if self.args.no_start_game:
+                print("No game but flag set to not start new game; aborting")
+                if self.lasttoot_id is not None and not self.args.debug:
+                    egmsg = "That's all folks!"
+                    print(egmsg)
+                    self.status_post(egmsg, in_reply_to_id=self.lasttoot_id,
+                                     visibility=("unlisted"))
+                    self.config["postid"] = None
+                    self.save_config()
+                self.stopped = True
+                return None
+            else:
+                # Create new game
+                self.lasttoot_id = None
+                self.config["postid"] = None
+                self.lastMove = None
+                board = chess.Board()
+                self.tracker = GameTracker(board)
+                self.player = chess.BLACK if self.config["human"].get("colour") == "BLACK" else chess.WHITE
+                lastMoveSan = None
+                if self.player == chess.BLACK:
+                    self.lastMove = None
+                    if self.config.get("polyglot_book") is not None:
+                        self.lastMove = opening_choice(board, self.config.get("polyglot_book"))[0]
+                    if self.lastMove is None:
+                        self.lastMove = chess.Move.from_uci(sample(book, 1)[0])
+                    lastMoveSan = board.variation_san([self.lastMove])
+                    self.tracker.push(self.lastMove)
+                self.set_up_vote(lastMoveSan, board, None)
+                pgn = chess.pgn.Game.from_board(board)
+                pgn.headers["Result"] = "*"
+                pgn = self.pgn_standard_headers(pgn, self.player)
+                print(pgn)
+                self.mirrors.settle()
+                self.state.start(board, self.config, self.tracker)
+                self.save_config()
+                return None
+        return board
 
+    def traced_turn(self):
+        # run_turn, with a timing span for each phase; the "metrics" config
+        # block says where the trace and the Prometheus totals are written
+        config = self.config.get("metrics") or {}
+        (before, self.pre_turn) = (self.pre_turn, None)
+        with trace_turn(self.name, config.get("trace_file"),
+                        config.get("prometheus_file"), before):
+            self.run_turn()
 
+    def run_turn(self):
+        # Depths may have been changed for the new game by clean_endgame
+        self.limithuman = chess.engine.Limit(depth=self.config["human"].get("depth"))
+        self.limitengine = chess.engine.Limit(depth=self.config["engine"].get("depth"))
+        self.speculation.stop()
+        board = self.load_game()
+        if board is None:
+            return
+        legmovs = list(board.legal_moves)
+        # 3. If only one legal move, just make it
+        if len(legmovs) == 1:
+            humMove = legmovs[0]
+        else:
+            # 4. Otherwise, gather results from thread for game. If tie, break with engine analysis, make move
+            humMove = self.get_vote_results(board)
+
+        self.speculation.settle(humMove)
+        if bool(humMove):
+            humMoveSan = board.variation_san([humMove])
+            self.tracker.push(humMove)
+        else:
+            humMoveSan = "resignation"
+
+        if not self.tracker.is_game_over(self.args.claim50) and bool(humMove):
+            # 6. Make engine move
+            # legmovs = list(board.legal_moves)
+            # engmov = self.eng_choose()
+            engmov = None
+            if board.fullmove_number < 10 and self.config.get("polyglot_book") is not None:
+                engmov = opening_choice(board, self.config.get("polyglot_book"))[0]
+
+            if engmov is None:
+                engmov = self.speculation.get("reply", board)
+            if engmov is None:
+                engmov = self.engine_reply(board, self.limitengine,
+                                           self.analysis_cache)
+
+            self.lastMove = engmov
+            lastMoveSan = board.variation_san([self.lastMove])
+            self.tracker.push(engmov)
+            if not self.tracker.is_game_over(self.args.claim50):
+                try:
+                    if board.halfmove_clock > 20 or board.halfmove_clock < 2:
+                        if len(board.piece_map()) < 8:
+                            with span("tablebase_probe"):
+                                wdl = self.tablebase.probe_wdl(board)
+                            if wdl == 0:
+                                print("Tablebase draw")
+                                self.clean_endgame(board, lastMoveSan, humMoveSan, True)
+                                return
+                except Exception as e:
+                    print("Failed to get adjudication")
+                    print(e)
+                self.set_up_vote(lastMoveSan, board, humMoveSan)
+                # Save board
+                print("saving")
+                self.mirrors.settle()
+                self.state.append(board, [humMove, engmov], self.config,
+                                  self.tracker)
+                self.speculate(board)
+            else:
+                self.clean_endgame(board, lastMoveSan, humMoveSan)
+        else:
+            self.clean_endgame(board, humMoveSan, None)
 
+    def engine_reply(self, board, lim, cache=None):
+        with self.engine_session.lock:
+            engmov = cached_analyse(board, self.engine_session.engine, lim,
+                                    cache)[1]
+            if engmov is None:
+                with span("engine_search", depth=lim.depth):
+                    engmov = self.engine_session.engine.play(board, lim).move
+        return engmov
 
+    def speculate(self, curBoard):
+        # Daemon mode: while the poll is open, rank its options for the
+        # tie-break, then find the engine's reply to each option, then rate
+        # the candidates after each reply. Nothing here touches the analysis
+        # cache, so the lines that lose the vote leave no trace.
+        spec = self.config.get("speculate")
+        if not self.args.daemon or spec is None or self.config.get("poll_options") is None:
+            return
+        print("Speculation: {} of {} results used".format(
+            self.speculation.hits, self.speculation.done))
+        options = [(curBoard.parse_san(mv) if mv != "Resign"
+                    else chess.Move.null()) for mv in self.config["poll_options"]]
+        (limitengine, replies) = (self.limitengine, dict())
+        book = self.config.get("polyglot_book") is not None
 
+        def ranking():
+            moves = eng_rate(options, curBoard.copy(), self.engine_session,
+                             limitengine,
+                             self.multipv_width(self.config["engine"]), None,
+                             self.tablebase)
+            return [("ranking", curBoard, [m[0] for m in moves])]
+
+        def reply(tracker):
+            # Book replies are random, so only the engine's can be predicted
+            board = tracker.board
+            if board.fullmove_number < 10 and book:
+                return []
+            replies[board.peek()] = self.engine_reply(board, limitengine)
+            return [("reply", board, replies[board.peek()])]
+
+        def candidates(tracker):
+            if replies.get(tracker.board.peek()) is None:
+                return []
+            tracker = tracker.copy()
+            tracker.push(replies[tracker.board.peek()])
+            board = tracker.board
+            if (tracker.is_game_over(self.args.claim50)
+                    or (board.fullmove_number < 10 and book)):
+                return []
+            return [("candidates", board,
+                     self.rate_candidates(board, list(board.legal_moves)))]
+
+        trackers = []
+        for mv in options:
+            if bool(mv):
+                tracker = self.tracker.copy()
+                tracker.push(mv)
+                if not tracker.is_game_over(self.args.claim50):
+                    trackers.append((mv, tracker))
+        jobs = [(None, ranking)]
+        jobs += [(mv, lambda t=tracker: reply(t)) for (mv, tracker) in trackers]
+        jobs += [(mv, lambda t=tracker: candidates(t)) for (mv, tracker) in trackers]
+        self.speculation.start(jobs, min(
+            spec.get("budget", 1800),
+            self.next_turn_delay(self.config.get("poll_length", 3600))))
+
+    def watching_poll(self):
+        return (self.args.daemon and not self.args.debug
+                and self.config.get("poll_watch") is not None
+                and self.config.get("poll_expires") is not None
+                and self.config.get("postid") is not None)
+
+    async def wait_for_poll(self, stop):
+        # Wait for the open poll to close, or to be decided early, as set in
+        # the "poll_watch" block. False if asked to stop instead.
+        watch = self.config["poll_watch"]
+        from pollwatch import PollWatcher
+        watcher = PollWatcher(
+            self.mastodon, self.config["postid"],
+            datetime.datetime.fromisoformat(self.config["poll_expires"]),
+            watch.get("lead"), watch.get("votes"),
+            watch.get("check_interval", 60), watch.get("max_interval", 900),
+            watch.get("stream", True))
+        reason = await watcher.wait(stop)
+        print("{}: poll {}".format(self.name, reason))
+        return reason != "stopped"
+
+    def close(self):
+        self.speculation.close()
+        self.posts.close()
+        self.mirrors.close()
+
+    def next_turn_delay(self, fallback):
+        # Seconds until the open poll closes (plus a grace period for the server
+        # to finalise it), or `fallback` when no poll is open
+        if self.config.get("poll_expires") is None:
+            return fallback
+        expires = datetime.datetime.fromisoformat(self.config["poll_expires"])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return max(0.0, (expires - now).total_seconds()) + POLL_GRACE
+
+
+async def play_game(game, stop):
+    # One-shot: play a single turn. Daemon: resume from the saved state,
+    # waiting out a poll that is still open, then play each turn as its poll
+    # expires until asked to stop.
+    loop = asyncio.get_running_loop()
+    delay = game.next_turn_delay(0) if game.args.daemon else 0
+    retrying = False
+    while not stop.is_set() and not game.stopped:
+        watched = False
+        if not retrying and game.watching_poll():
+            print("{}: watching the poll, which closes in {:.0f}s".format(
+                game.name, max(0, delay - POLL_GRACE)))
+            try:
+                if not await game.wait_for_poll(stop):
+                    break
+                watched = True
+            except Exception:
+                # Fall back to waiting out the expiry time
+                print("{}: failed to watch the poll".format(game.name))
+                traceback.print_exc()
+                delay = game.next_turn_delay(0)
+        if not watched:
+            if game.args.daemon:
+                print("{}: next turn in {:.0f}s".format(game.name, delay))
+            try:
+                await asyncio.wait_for(stop.wait(), delay)
+                break
+            except asyncio.TimeoutError:
+                pass
+        try:
+            await loop.run_in_executor(None, game.traced_turn)
+            delay = game.next_turn_delay(game.config.get("poll_length", 3600))
+            retrying = False
+        except Exception:
+            if not game.args.daemon:
+                raise
+            print("{}: turn failed; retrying in {}s".format(game.name,
+                                                            DAEMON_RETRY))
+            traceback.print_exc()
+            # Drop anything the failed turn changed but never saved
+            game.reload_config()
+            delay = DAEMON_RETRY
+            retrying = True
+        if game.analysis_cache is not None:
+            print("Analysis cache: {} hits, {} misses".format(
+                game.analysis_cache.hits, game.analysis_cache.misses))
+            game.analysis_cache.flush()
+        if len(game.screen_stats) > 0:
+            print("Candidate screen: {} moves screened, {} pruned, {} searched "
+                  "in full in {} engine searches".format(
+                      game.screen_stats.get("screened", 0),
+                      game.screen_stats.get("pruned", 0),
+                      game.screen_stats.get("deep", 0),
+                      game.screen_stats.get("searches", 0)))
+            game.screen_stats.clear()
+        sys.stdout.flush()
+        if not game.args.daemon:
+            break
+
+
+async def run_games(games):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    # Finish the turns in progress, if any, then exit
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    results = await asyncio.gather(*[play_game(game, stop) for game in games],
+                                   return_exceptions=True)
+    failed = 0
+    for (game, result) in zip(games, results):
+        if isinstance(result, BaseException):
+            print("{}: turn failed".format(game.name))
+            traceback.print_exception(type(result), result,
+                                      result.__traceback__)
+            failed = failed + 1
+    return failed
+
+
+def main():
+    args = parser.parse_args()
+    os.chdir(args.dir)
+    seed()
+    # The engine processes must be shut down on every exit path, or their
+    # (non-daemon) I/O threads keep the interpreter alive
+    games = []
+    try:
+        for configfp in args.config_files:
+            games.append(VoteChessGame(configfp, args))
+        failed = asyncio.run(run_games(games))
+    finally:
+        for game in games:
+            game.close()
+        close_sessions()
+        close_books()
+        close_caches()
+        close_tablebases()
+        close_archives()
+    if failed > 0:
+        sys.exit(1)
 
 
+if __name__ == "__main__":
+    main()